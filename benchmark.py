@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# offline benchmark of dynamodump backups and restores. seeds a synthetic table into
+# DynamoDB Local (or moto's in-process mock), backs it up to a local dump directory or
+# a local S3 stand-in, restores it into a second table and emits the end to end and
+# per stage timings of every run as JSON, so hot loop regressions can be tracked.
+import json
+import sys
+import os
+import time
+import random
+import binascii
+import argparse
+import logging
+import shutil
+import tempfile
+import platform
+import functools
+from boto.dynamodb2.layer1 import DynamoDBConnection
+import boto.dynamodb2
+
+import dynamodump
+
+BENCHMARK_TABLE = "dynamodump-benchmark"
+MOTO_REGION = "us-east-1"
+KEY_DISTRIBUTIONS = ["uniform", "sequential", "hot"]
+HOT_KEYS = 10
+SEED_WRITE_THREADS = 8
+SEED_BATCH_PAGE = 1000 #items
+
+def synthetic_items(item_count, item_size, key_distribution, seed):
+  # hash key "pk" spread according to the distribution, range key "sk" unique per item
+  rng = random.Random(seed)
+  for i in xrange(item_count):
+    if key_distribution == "uniform":
+      pk = "%016x" % rng.getrandbits(64)
+    elif key_distribution == "sequential":
+      pk = "key-" + str(i).zfill(12)
+    else:
+      # a few hot partitions take most of the items
+      pk = "hot-" + str(int(rng.paretovariate(1.16)) % HOT_KEYS)
+    yield {"pk": {"S": pk}, "sk": {"N": str(i)},
+           "payload": {"S": binascii.hexlify(os.urandom(item_size / 2 + 1))[:item_size]}}
+
+def item_pages(item_count, item_size, key_distribution, seed):
+  items = synthetic_items(item_count, item_size, key_distribution, seed)
+  for page in xrange(0, item_count, SEED_BATCH_PAGE):
+    yield "seed-" + str(page), (items.next() for i in xrange(min(SEED_BATCH_PAGE, item_count - page)))
+
+def create_table(conn, sleep_interval, table_name, capacity):
+  dynamodump.delete_table(conn, sleep_interval, table_name)
+  conn.create_table([{"AttributeName": "pk", "AttributeType": "S"},
+                     {"AttributeName": "sk", "AttributeType": "N"}],
+                    table_name,
+                    [{"AttributeName": "pk", "KeyType": "HASH"},
+                     {"AttributeName": "sk", "KeyType": "RANGE"}],
+                    {"ReadCapacityUnits": capacity, "WriteCapacityUnits": capacity})
+  dynamodump.wait_for_active_table(conn, table_name, "created")
+
+def table_summary(table_name, operation, since):
+  # summary of the latest backup or restore of a table tracked after index since
+  for table_metrics in reversed(dynamodump.table_metrics_registry[since:]):
+    if table_metrics.table_name == table_name and table_metrics.operation == operation:
+      summary = table_metrics.summary()
+      del summary["segments"]
+      return summary
+  return None
+
+def run_benchmark(conn, sleep_interval, s3conn, args, run):
+  source_table = BENCHMARK_TABLE + "-" + str(run)
+  restored_table = source_table + "-restored"
+  dump_path = args.dumpPath
+  if not args.s3bucket:
+    dump_path = tempfile.mkdtemp(prefix="dynamodump-benchmark-")
+  result = {"run": run}
+  since = len(dynamodump.table_metrics_registry)
+
+  try:
+    logging.info("Seeding " + str(args.items) + " items of " + str(args.itemSize) + " bytes into " + source_table + "..")
+    create_table(conn, sleep_interval, source_table, args.capacity)
+    start = time.time()
+    failures = dynamodump.restore_items(conn, source_table,
+                                        item_pages(args.items, args.itemSize, args.keyDistribution, run),
+                                        SEED_WRITE_THREADS)
+    if len(failures) > 0:
+      logging.error("Seeding " + source_table + " failed")
+      sys.exit(1)
+    result["seed_seconds"] = round(time.time() - start, 3)
+
+    start = time.time()
+    dynamodump.do_backup(conn, source_table, None, s3conn, args.s3bucket, None, dump_path,
+                         args.segments, dump_format=args.format)
+    result["backup"] = table_summary(source_table, "backup", since)
+    result["backup"]["end_to_end_seconds"] = round(time.time() - start, 3)
+
+    start = time.time()
+    dynamodump.delete_table(conn, sleep_interval, restored_table)
+    dynamodump.do_restore(conn, sleep_interval, source_table, restored_table, args.capacity,
+                          s3conn, args.s3bucket, dump_path, args.writeThreads, processes=args.processes)
+    result["restore"] = table_summary(restored_table, "restore", since)
+    result["restore"]["end_to_end_seconds"] = round(time.time() - start, 3)
+  finally:
+    if not args.keep:
+      for table_name in [source_table, restored_table]:
+        dynamodump.delete_table(conn, sleep_interval, table_name)
+      if args.s3bucket:
+        bucket = s3conn.get_bucket(args.s3bucket)
+        bucket.delete_keys([key.name for key in bucket.list(dump_path + "/" + source_table + "/")])
+      else:
+        shutil.rmtree(dump_path, ignore_errors=True)
+
+  return result
+
+def run_benchmarks(args):
+  if args.host:
+    conn_factory = functools.partial(DynamoDBConnection,
+      aws_access_key_id=args.accessKey,
+      aws_secret_access_key=args.secretKey,
+      host=args.host,
+      port=int(args.port),
+      is_secure=False
+    )
+  else:
+    conn_factory = functools.partial(boto.dynamodb2.connect_to_region,
+      MOTO_REGION,
+      aws_access_key_id=args.accessKey,
+      aws_secret_access_key=args.secretKey
+    )
+  sleep_interval = dynamodump.LOCAL_SLEEP_INTERVAL
+  conn = dynamodump.ConnectionPool(conn_factory, args.maxConnections)
+
+  s3conn = None
+  if args.s3bucket:
+    s3conn = dynamodump.ConnectionPool(functools.partial(dynamodump.connect_to_s3, args.s3host, args.s3port),
+                                       args.maxConnections)
+
+  config = dict(vars(args))
+  del config["accessKey"], config["secretKey"]
+  results = {"config": config,
+             "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                             "json_codec": dynamodump.json_codec_name},
+             "started": time.time(),
+             "runs": []}
+  for run in range(1, args.runs + 1):
+    logging.info("Benchmark run " + str(run) + "/" + str(args.runs))
+    results["runs"].append(run_benchmark(conn, sleep_interval, s3conn, args, run))
+  return results
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Offline dynamodump backup/restore benchmark.")
+  parser.add_argument("--host",
+    help="Host of DynamoDB Local, e.g. 'localhost' [optional, uses moto's in-process mock if omitted]")
+  parser.add_argument("--port",
+    default=8000,
+    help="Port of DynamoDB Local [defaults to 8000, optional]")
+  parser.add_argument("--accessKey",
+    default="benchmark",
+    help="Access key of DynamoDB Local [optional]")
+  parser.add_argument("--secretKey",
+    default="benchmark",
+    help="Secret key of DynamoDB Local [optional]")
+  parser.add_argument("--items",
+    type=int, default=10000,
+    help="Number of items to seed [defaults to 10000, optional]")
+  parser.add_argument("--itemSize",
+    type=int, default=1024,
+    help="Size in bytes of the payload attribute of each item [defaults to 1024, optional]")
+  parser.add_argument("--keyDistribution",
+    default="uniform", choices=KEY_DISTRIBUTIONS,
+    help="Hash key distribution, 'hot' puts most items under " + str(HOT_KEYS) + " hash keys [defaults to uniform, optional]")
+  parser.add_argument("--capacity",
+    type=int, default=1000,
+    help="Read and write capacity of the benchmark tables [defaults to 1000, optional]")
+  parser.add_argument("--segments",
+    type=int, default=1,
+    help="Number of parallel scan segments to backup with [defaults to 1, optional]")
+  parser.add_argument("--format",
+    default="json", choices=dynamodump.DUMP_FORMATS,
+    help="Format of backup data files [defaults to json, optional]")
+  parser.add_argument("--jsonCodec",
+    default="auto", choices=dynamodump.JSON_CODECS,
+    help="JSON codec to encode and decode data files with [defaults to auto, optional]")
+  parser.add_argument("--writeThreads",
+    type=int, default=dynamodump.RESTORE_WRITE_THREADS,
+    help="Number of threads writing batches to the restored table [defaults to " + str(dynamodump.RESTORE_WRITE_THREADS) + ", optional]")
+  parser.add_argument("--processes",
+    type=int, default=1,
+    help="Number of processes to restore with [defaults to 1, optional]")
+  parser.add_argument("--maxConnections",
+    type=int, default=dynamodump.CONNECTION_POOL_SIZE,
+    help="Maximum number of DynamoDB and of s3 connections [defaults to " + str(dynamodump.CONNECTION_POOL_SIZE) + ", optional]")
+  parser.add_argument("--runs",
+    type=int, default=1,
+    help="Number of times to seed, backup and restore [defaults to 1, optional]")
+  parser.add_argument("--s3bucket",
+    help="S3 bucket to backup to and restore from, on the --s3host stand-in or moto's in-process mock [optional]")
+  parser.add_argument("--s3host",
+    help="Host of a local S3 stand-in, e.g. moto_server [optional]")
+  parser.add_argument("--s3port",
+    type=int,
+    help="Port of the local S3 stand-in [optional]")
+  parser.add_argument("--dumpPath",
+    default="benchmark",
+    help="Key prefix of the dumps in the S3 bucket, local dumps go to a temporary directory [defaults to benchmark, optional]")
+  parser.add_argument("--keep",
+    action="store_true",
+    help="Keep the benchmark tables and dumps [optional]")
+  parser.add_argument("--output",
+    help="File to write the JSON results to [optional, defaults to stdout]")
+  parser.add_argument("--log",
+    default="WARNING",
+    help="Logging level - DEBUG|INFO|WARNING|ERROR|CRITICAL [defaults to WARNING, optional]")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=getattr(logging, args.log.upper()))
+
+  if args.jsonCodec == "ujson" and dynamodump.ujson is None:
+    parser.error("the ujson codec requires the ujson package")
+  if args.writeThreads < 1:
+    parser.error("--writeThreads must be at least 1")
+  dynamodump.json_codec_name, dynamodump.encode_json, dynamodump.decode_json = dynamodump.json_codec(args.jsonCodec)
+
+  # without a DynamoDB Local host or S3 stand-in, run against moto's in-process mocks
+  mocks = []
+  if not args.host or (args.s3bucket and not args.s3host):
+    try:
+      import moto
+    except ImportError:
+      parser.error("moto is required unless --host and, with --s3bucket, --s3host point at local stand-ins")
+    if not args.host:
+      mocks.append(moto.mock_dynamodb2_deprecated())
+    if args.s3bucket and not args.s3host:
+      mocks.append(moto.mock_s3_deprecated())
+    # the mocks accept any credentials, but boto refuses to sign requests without some
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", args.accessKey)
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", args.secretKey)
+  for mock in mocks:
+    mock.start()
+  try:
+    results = run_benchmarks(args)
+  finally:
+    for mock in mocks:
+      mock.stop()
+
+  if args.output:
+    dynamodump.write_text_file(args.output, json.dumps(results, indent=dynamodump.JSON_INDENT))
+  else:
+    print json.dumps(results, indent=dynamodump.JSON_INDENT)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import json
 import sys
+import errno
 import time
 import shutil
 import os
@@ -8,56 +9,215 @@ import argparse
 import logging
 import datetime
 import threading
+import random
+import Queue
+import zlib
+import tempfile
+import functools
+import itertools
+import bisect
+import fnmatch
+import re
+import hashlib
+import base64
+import decimal
+import atexit
+import multiprocessing
+import weakref
+from cStringIO import StringIO
 from boto.dynamodb2.layer1 import DynamoDBConnection
 import boto.dynamodb2.layer1
 from boto.s3.connection import S3Connection
 from boto.s3.connection import Location
 from boto.s3.connection import Key
+from boto.s3.connection import OrdinaryCallingFormat
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+try:
+  import ujson
+except ImportError:
+  ujson = None
 
 JSON_INDENT = 2
 AWS_SLEEP_INTERVAL = 10 #seconds
 LOCAL_SLEEP_INTERVAL = 1 #seconds
 MAX_BATCH_WRITE = 25 #DynamoDB limit
+MAX_BATCH_GET = 100 #DynamoDB limit
+MAX_S3_DELETE = 1000 #S3 limit of keys per multi-object delete
 SCHEMA_FILE = "schema.json"
+MANIFEST_FILE = "manifest.json"
 DATA_DIR = "data"
 MAX_RETRY = 6
+BACKOFF_BASE = 0.05 #seconds
+MAX_BACKOFF = 20 #seconds
+RESTORE_WRITE_THREADS = 4
+PROCESS_REPORT_INTERVAL = 1 #seconds between metrics sent by restore processes to the parent
 LOCAL_REGION = "local"
 LOG_LEVEL = "INFO"
 DUMP_PATH = "dump"
+SEGMENT_DIR = "segments"
+CHECKPOINT_FILE = "checkpoint.json"
+CHECKPOINT_DIR = ".dynamodump" #restore checkpoints, relative to the working directory
+CHECKPOINT_INTERVAL = 10 #seconds
+SNAPSHOT_FILE = "snapshot.json"
+DELTA_DIR = "deltas"
+INCREMENTAL_OVERLAP = 60 #seconds, re-captured before the previous dump started to allow for clock skew
+TIMESTAMP_FORMATS = ["epoch", "epoch_ms", "iso8601"]
+JSON_CODECS = ["auto", "ujson", "json"]
+DUMP_FORMATS = ["json", "ndjson.gz", "ndjson.zst"]
+MAX_CHUNK_SIZE = 64 * 1024 * 1024 #bytes of uncompressed item data per chunk file
+READ_BLOCK_SIZE = 1024 * 1024 #bytes
+S3_UPLOAD_THREADS = 4
+S3_UPLOAD_MEMORY = 256 #megabytes
+S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024 #bytes
+S3_MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024 #bytes, S3 minimum part size is 5MB
+S3_PREFETCH = 4 #objects
+COPY_PREFETCH = 16 #scan pages read ahead of the writers of a copy
 RESTORE_WRITE_CAPACITY = 100
-THREAD_START_DELAY = 1 #seconds
+VERIFY_SAMPLES = 100 #items read back from the table per verified dump
+TABLE_WORKERS = 4
+CONNECTION_POOL_SIZE = 64
+WATCH_MIN_INTERVAL = 0.25 #seconds between the first status polls of a table, doubled every poll
+WATCH_MAX_INTERVAL = 2 #seconds between status polls of a table
+WATCH_POLL_RATE = 10 #DescribeTable calls per second, shared by all tables being waited on
+WATCH_NOT_FOUND_POLLS = 5 #polls a table waited on to be active may be missing for, new tables can take a moment to be described
+PROGRESS_INTERVAL = 30 #seconds
+METRIC_COUNTERS = ["items", "bytes", "requests", "capacity_units", "throttles", "retries", "unprocessed_items"]
+# seconds spent per stage of the hot loops, summed over every thread of a table
+METRIC_STAGES = ["scan", "serialize", "write", "parse", "batch_write"]
 CURRENT_WORKING_DIR = os.getcwd()
 DEFAULT_PREFIX_SEPARATOR = "-"
-
-def get_table_name_matches(conn, table_name_wildcard, separator):
-  all_tables = []
+TABLE_CATALOG_TTL = 60 #seconds a listing of tables or dumps is reused by wildcard lookups
+GLOB_CHARACTERS = "*?["
+REGEX_PATTERN_PREFIX = "re:"
+
+# table name patterns: "prefix*" matches the tables named prefix<separator>.. (or
+# starting with prefix without a separator), other globs such as "*-users" or
+# "prod-??-orders" match the whole name and "re:<regex>" matches a regular expression
+# against the whole name
+class TablePattern(object):
+
+  def __init__(self, pattern, separator):
+    self.pattern = pattern
+    self.separator = separator
+    if pattern.startswith(REGEX_PATTERN_PREFIX):
+      regex = pattern[len(REGEX_PATTERN_PREFIX):]
+      self.kind = "regex"
+      self.regex = re.compile("(?:" + regex + r")\Z")
+      self.prefix = regex_literal_prefix(regex)
+    elif pattern.endswith("*") and not is_table_pattern(pattern[:-1]):
+      self.kind = "prefix"
+      self.prefix = pattern[:-1]
+    else:
+      self.kind = "glob"
+      self.regex = re.compile(fnmatch.translate(pattern))
+      self.prefix = re.split("[" + re.escape(GLOB_CHARACTERS) + "]", pattern, 1)[0]
+
+  def matches(self, name):
+    if self.kind != "prefix":
+      return self.regex.match(name) is not None
+    elif self.separator == None:
+      return name.startswith(self.prefix)
+    else:
+      return name.split(self.separator, 1)[0] == self.prefix
+
+def is_table_pattern(table_name):
+  return table_name.startswith(REGEX_PATTERN_PREFIX) or any(c in table_name for c in GLOB_CHARACTERS)
+
+def regex_literal_prefix(regex):
+  # literal text every match starts with, empty when alternation or inline flags could
+  # change that
+  if "|" in regex or "(?" in regex:
+    return ""
+  literal = re.match(r"\^?([\w-]*)", regex)
+  prefix = literal.group(1)
+  if regex[literal.end():literal.end() + 1] in ("?", "*", "{"):
+    # the last character is optional
+    prefix = prefix[:-1]
+  return prefix
+
+# sorted listing of table or dump names, reused for TABLE_CATALOG_TTL seconds. a pattern
+# is only tried on the names sharing its literal prefix, found by bisection
+class NameCatalog(object):
+
+  def __init__(self, list_names, ttl=TABLE_CATALOG_TTL):
+    self.list_names = list_names
+    self.ttl = ttl
+    self.names = None
+    self.listed = 0
+    self.lock = threading.Lock()
+
+  def sorted_names(self):
+    with self.lock:
+      if self.names is None or time.time() - self.listed > self.ttl:
+        self.names = sorted(self.list_names())
+        self.listed = time.time()
+      return self.names
+
+  def invalidate(self):
+    with self.lock:
+      self.names = None
+
+  def match(self, pattern):
+    names = self.sorted_names()
+    start = bisect.bisect_left(names, pattern.prefix)
+    candidates = itertools.takewhile(lambda name: name.startswith(pattern.prefix), itertools.islice(names, start, None))
+    return [name for name in candidates if pattern.matches(name)]
+
+name_catalogs = {}
+name_catalogs_lock = threading.Lock()
+
+def name_catalog(key, list_names):
+  with name_catalogs_lock:
+    if key not in name_catalogs:
+      name_catalogs[key] = NameCatalog(list_names)
+    return name_catalogs[key]
+
+def table_catalog(conn):
+  # one listing per connection, shared by the backup, deletion and restore lookups
+  return name_catalog(("tables", id(conn)), functools.partial(list_table_names, conn))
+
+def list_table_names(conn):
+  table_names = []
   last_evaluated_table_name = None
 
   while True:
     table_list = conn.list_tables(exclusive_start_table_name=last_evaluated_table_name)
-    all_tables.extend(table_list["TableNames"])
+    table_names.extend(table_list["TableNames"])
 
     try:
       last_evaluated_table_name = table_list["LastEvaluatedTableName"]
     except KeyError, e:
       break
 
-  matching_tables = []
-  for table_name in all_tables:
-    if separator == None:
-      if table_name.startswith(table_name_wildcard.split("*", 1)[0]):
-        matching_tables.append(table_name)
-    elif table_name.split(separator, 1)[0] == table_name_wildcard.split("*", 1)[0]:
-      matching_tables.append(table_name)
+  return table_names
 
-  return matching_tables
+def get_table_name_matches(conn, table_name_wildcard, separator):
+  return table_catalog(conn).match(TablePattern(table_name_wildcard, separator))
 
-def get_restore_table_matches(table_name_wildcard, separator):
-  matching_tables = []
+def list_dump_dirs(s3conn, s3bucket, dump_path):
+  if s3bucket:
+    # table dumps are the "directories" directly under <dumpPath>/
+    prefix = (dump_path or DUMP_PATH) + "/"
+    bucket_id = s3conn.get_bucket(s3bucket)
+    return [entry.name[len(prefix):].rstrip("/") for entry in bucket_id.list(prefix=prefix, delimiter="/")]
+  else:
+    return list_local_dump_dirs(dump_path or DUMP_PATH)
+
+def get_restore_table_matches(table_name_wildcard, separator, s3conn=None, s3bucket=None, dump_path=None):
+  catalog = name_catalog(("dumps", id(s3conn) if s3bucket else None, s3bucket, dump_path or DUMP_PATH),
+                         functools.partial(list_dump_dirs, s3conn, s3bucket, dump_path))
+  return catalog.match(TablePattern(table_name_wildcard, separator))
+
+def list_local_dump_dirs(dump_path):
   try:
-    dir_list = os.listdir("./" + DUMP_PATH)
+    dir_list = os.listdir("./" + dump_path)
   except OSError:
-    logging.info("Cannot find \"./%s\", Now trying current working directory.." % DUMP_PATH)
+    logging.info("Cannot find \"./%s\", Now trying current working directory.." % dump_path)
     dump_data_path = CURRENT_WORKING_DIR
     try:
       dir_list = os.listdir(dump_data_path)
@@ -65,29 +225,107 @@ def get_restore_table_matches(table_name_wildcard, separator):
       logging.info("Cannot find \"%s\" directory containing dump files!" % dump_data_path)
       sys.exit(1)
 
-  for dir_name in dir_list:
-    if dir_name.split(separator, 1)[0] == table_name_wildcard.split("*", 1)[0]:
-      matching_tables.append(dir_name)
-
-  return matching_tables
+  return dir_list
 
 def change_prefix(source_table_name, source_wildcard, destination_wildcard, separator):
-  source_prefix = source_wildcard.split("*", 1)[0]
+  if destination_wildcard == source_wildcard:
+    return source_table_name
+  source_pattern = TablePattern(source_wildcard, separator)
   destination_prefix = destination_wildcard.split("*", 1)[0]
-  if source_table_name.split(separator, 1)[0] == source_prefix:
-    return destination_prefix + separator + source_table_name.split(separator, 1)[1]
+  if source_pattern.kind == "prefix":
+    if source_table_name.split(separator, 1)[0] == source_pattern.prefix:
+      return destination_prefix + separator + source_table_name.split(separator, 1)[1]
+  else:
+    # glob and regex sources swap the literal prefix of the pattern for the destination's
+    return destination_prefix + source_table_name[len(source_pattern.prefix):]
+
+def table_size(table_desc):
+  table = table_desc["Table"]
+  return (table.get("TableSizeBytes", 0), table.get("ItemCount", 0))
+
+def order_tables_by_size(conn, table_names):
+  # largest first, so the biggest table never starts last and bounds the total run time
+  sizes = {}
+  for table_name in table_names:
+    try:
+      sizes[table_name] = table_size(conn.describe_table(table_name))
+    except boto.exception.JSONResponseError, e:
+      sizes[table_name] = (0, 0)
+  return sorted(table_names, key=lambda table_name: sizes[table_name], reverse=True)
+
+def order_dumps_by_size(table_names, s3conn, s3bucket, dump_path):
+  # restores are ordered by the table size recorded in each dump's schema
+  sizes = {}
+  bucket_id = None
+  if s3bucket:
+    bucket_id = s3conn.get_bucket(s3bucket)
+  for table_name in table_names:
+    schema_path = (dump_path or DUMP_PATH) + "/" + table_name + "/" + SCHEMA_FILE
+    if not bucket_id and not os.path.exists(schema_path):
+      schema_path = CURRENT_WORKING_DIR + "/" + table_name + "/" + SCHEMA_FILE
+    table_desc = read_json_file(schema_path, bucket_id)
+    sizes[table_name] = (0, 0)
+    if table_desc is not None:
+      sizes[table_name] = table_size(table_desc)
+  return sorted(table_names, key=lambda table_name: sizes[table_name], reverse=True)
+
+def run_table_jobs(job, table_names, workers, verb):
+  # runs job(table_name) for every table, in order, on a bounded pool of worker threads
+  if workers < 1:
+    raise ValueError("workers must be at least 1, no table would be processed")
+  jobs = Queue.Queue()
+  for table_name in table_names:
+    jobs.put(table_name)
+  status = dict((table_name, "pending") for table_name in table_names)
+  lock = threading.Lock()
+
+  def worker():
+    while True:
+      try:
+        table_name = jobs.get_nowait()
+      except Queue.Empty:
+        return
+      with lock:
+        status[table_name] = "running"
+      table_start_time = time.time()
+      try:
+        job(table_name)
+        result = "completed"
+      except SystemExit, e:
+        result = "failed"
+      except Exception, e:
+        logging.exception(e)
+        result = "failed"
+      with lock:
+        status[table_name] = result
+        finished = len([s for s in status.values() if s in ("completed", "failed")])
+        running = [t for t in table_names if status[t] == "running"]
+      logging.info(verb.capitalize() + " of " + table_name + " " + result + " in " + str(int(time.time() - table_start_time)) + "s, " + str(finished) + "/" + str(len(table_names)) + " table(s) done" + (", running: " + ", ".join(running) if running else ""))
+
+  threads = []
+  for i in range(min(workers, len(table_names))):
+    t = threading.Thread(target=worker)
+    threads.append(t)
+    t.start()
+
+  for thread in threads:
+    thread.join()
+
+  failed_tables = [table_name for table_name in table_names if status[table_name] == "failed"]
+  if len(failed_tables) > 0:
+    logging.error(verb.capitalize() + " failed for " + str(len(failed_tables)) + " table(s): " + ", ".join(failed_tables))
+  return failed_tables
 
 def delete_table(conn, sleep_interval, table_name):
   while True:
     # delete table if exists
-    table_exist = True
     try:
       conn.delete_table(table_name)
+      break
     except boto.exception.JSONResponseError, e:
       if e.body["__type"] == "com.amazonaws.dynamodb.v20120810#ResourceNotFoundException":
-        table_exist = False
         logging.info(table_name + " table deleted!")
-        break
+        return
       elif e.body["__type"] == "com.amazonaws.dynamodb.v20120810#LimitExceededException":
         logging.info("Limit exceeded, retrying deletion of " + table_name + "..")
         time.sleep(sleep_interval)
@@ -95,25 +333,16 @@ def delete_table(conn, sleep_interval, table_name):
         logging.info("Control plane limit exceeded, retrying deletion of " + table_name + "..")
         time.sleep(sleep_interval)
       elif e.body["__type"] == "com.amazonaws.dynamodb.v20120810#ResourceInUseException":
-        logging.info(table_name + " table is being deleted..")
-        time.sleep(sleep_interval)
+        # being created, updated or already deleted, retry once that is done
+        table_watcher(conn).wait(table_name, "settled", "ready for deletion")
       else:
         logging.exception(e)
         sys.exit(1)
 
-  # if table exists, wait till deleted
-  if table_exist:
-    try:
-      while True:
-        logging.info("Waiting for " + table_name + " table to be deleted.. [" + conn.describe_table(table_name)["Table"]["TableStatus"] +"]")
-        time.sleep(sleep_interval)
-    except boto.exception.JSONResponseError, e:
-      if e.body["__type"] == "com.amazonaws.dynamodb.v20120810#ResourceNotFoundException":
-        logging.info(table_name + " table deleted.")
-        pass
-      else:
-        logging.exception(e)
-        sys.exit(1)
+  # wait till deleted
+  table_watcher(conn).wait(table_name, "deleted", "deleted")
+  table_catalog(conn).invalidate()
+  logging.info(table_name + " table deleted.")
 
 def mkdir_p(path):
   try:
@@ -123,57 +352,944 @@ def mkdir_p(path):
       pass
     else: raise
 
-def batch_write(conn, sleep_interval, table_name, put_requests):
+def backoff_delay(attempt):
+  # exponential backoff with full jitter
+  return random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * (2 ** attempt)))
+
+def throughput_exceeded(e):
+  # requests refused for capacity, to be retried after a backoff
+  return e.body["__type"] == "com.amazonaws.dynamodb.v20120810#ProvisionedThroughputExceededException" or \
+    e.body["__type"] == "com.amazon.coral.availability#ThrottlingException"
+
+# token bucket refilled at rate capacity units per second, callers acquire() before a
+# request and consume() the units DynamoDB reports afterwards. the bucket may go into
+# debt which later callers wait off, as request costs are only known after the fact.
+class TokenBucket(object):
+
+  def __init__(self, rate, burst=None):
+    self.rate = float(rate)
+    self.burst = float(burst or rate)
+    self.tokens = self.burst
+    self.last_refill = time.time()
+    self.lock = threading.Lock()
+
+  def _refill(self):
+    now = time.time()
+    self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+    self.last_refill = now
+
+  def acquire(self):
+    while True:
+      with self.lock:
+        self._refill()
+        if self.tokens > 0:
+          return
+        wait = -self.tokens / self.rate
+      time.sleep(wait)
+
+  def consume(self, units):
+    with self.lock:
+      self._refill()
+      self.tokens -= units
+
+# token bucket kept in shared memory, so the restore processes forked after its
+# creation draw from one budget
+class SharedTokenBucket(TokenBucket):
+
+  def __init__(self, rate, burst=None):
+    self.shared = multiprocessing.Array("d", 2)
+    TokenBucket.__init__(self, rate, burst)
+    self.lock = self.shared.get_lock()
+
+  @property
+  def tokens(self):
+    return self.shared[0]
+
+  @tokens.setter
+  def tokens(self, tokens):
+    self.shared[0] = tokens
+
+  @property
+  def last_refill(self):
+    return self.shared[1]
+
+  @last_refill.setter
+  def last_refill(self, last_refill):
+    self.shared[1] = last_refill
+
+# limiters are only kept while a run holds on to them
+rate_limiters = weakref.WeakValueDictionary()
+rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(table_name, capacity_type, provisioned_capacity, capacity_ratio, shared=False):
+  # one limiter per table, capacity type and rate, shared by every thread in the process
+  # running at once, and by restore processes forked later if shared is set
+  if capacity_ratio is None or not provisioned_capacity:
+    return None
+
+  rate = max(1.0, float(provisioned_capacity) * float(capacity_ratio))
+  with rate_limiters_lock:
+    key = (table_name, capacity_type, rate)
+    rate_limiter = rate_limiters.get(key)
+    if rate_limiter is None or (shared and not isinstance(rate_limiter, SharedTokenBucket)):
+      logging.info("Limiting " + capacity_type + " capacity of " + table_name + " to " + str(rate) + " units/s")
+      if shared:
+        rate_limiter = SharedTokenBucket(rate)
+      else:
+        rate_limiter = TokenBucket(rate)
+      rate_limiters[key] = rate_limiter
+    return rate_limiter
+
+def consumed_capacity_units(response):
+  consumed_capacity = response.get("ConsumedCapacity")
+  if consumed_capacity is None:
+    return 0
+  # batch operations return a list, one entry per table
+  if isinstance(consumed_capacity, list):
+    return sum(consumed["CapacityUnits"] for consumed in consumed_capacity)
+  return consumed_capacity["CapacityUnits"]
+
+def stage_counters():
+  return [stage + "_seconds" for stage in METRIC_STAGES]
+
+# counters of a backup or restore of one table, in total and per scan segment
+class TableMetrics(object):
+  def __init__(self, table_name, operation, expected_items=None):
+    self.table_name = table_name
+    self.operation = operation
+    self.expected_items = expected_items
+    self.status = "running"
+    self.start = time.time()
+    self.end = None
+    self.totals = dict((counter, 0) for counter in METRIC_COUNTERS + stage_counters())
+    self.segments = {}
+    self.lock = threading.Lock()
+
+  def add(self, segment=None, **counts):
+    with self.lock:
+      if segment is not None:
+        segment_totals = self.segments.setdefault(segment, dict((counter, 0) for counter in METRIC_COUNTERS + stage_counters()))
+      for counter, value in counts.items():
+        self.totals[counter] += value
+        if segment is not None:
+          segment_totals[counter] += value
+
+  def finish(self, status="completed"):
+    self.status = status
+    self.end = time.time()
+
+  def elapsed(self):
+    return max((self.end or time.time()) - self.start, 0.001)
+
+  def eta(self):
+    # seconds left at the current item rate, from the table's approximate ItemCount
+    if not self.expected_items or self.totals["items"] == 0:
+      return None
+    remaining = max(self.expected_items - self.totals["items"], 0)
+    return int(remaining / (self.totals["items"] / self.elapsed()))
+
+  def summary(self):
+    with self.lock:
+      elapsed = self.elapsed()
+      summary = {"table": self.table_name, "operation": self.operation, "status": self.status,
+                 "started": self.start, "seconds": round(elapsed, 3), "expected_items": self.expected_items}
+      summary.update(self.totals)
+      summary["items_per_second"] = round(self.totals["items"] / elapsed, 3)
+      summary["bytes_per_second"] = round(self.totals["bytes"] / elapsed, 3)
+      summary["capacity_units_per_second"] = round(self.totals["capacity_units"] / elapsed, 3)
+      summary["unprocessed_items_per_second"] = round(self.totals["unprocessed_items"] / elapsed, 3)
+      summary["stages"] = dict((stage, round(self.totals[stage + "_seconds"], 3)) for stage in METRIC_STAGES)
+      summary["segments"] = dict((str(segment), dict(totals)) for segment, totals in self.segments.items())
+    return summary
+
+  def progress(self):
+    summary = self.summary()
+    line = self.operation + " " + self.table_name + ": " + str(summary["items"])
+    if self.expected_items:
+      line += "/" + str(self.expected_items) + " items (" + str(min(100, summary["items"] * 100 / self.expected_items)) + "%)"
+    else:
+      line += " items"
+    line += ", " + str(int(summary["items_per_second"])) + " items/s, " + str(round(summary["bytes_per_second"] / 1024 / 1024, 2)) + " MB/s, " + \
+            str(round(summary["capacity_units_per_second"], 1)) + " units/s, " + str(summary["throttles"]) + " throttles, " + \
+            str(summary["unprocessed_items"]) + " unprocessed"
+    eta = self.eta()
+    if eta is not None:
+      line += ", ETA " + str(datetime.timedelta(seconds=eta))
+    return line
+
+table_metrics_registry = []
+table_metrics_lock = threading.Lock()
+# tables tracked by a Job go to the job's own list instead of the registry, see Job
+table_metrics_scope = threading.local()
+
+def track_table(table_name, operation, expected_items=None):
+  table_metrics = TableMetrics(table_name, operation, expected_items)
+  registry = getattr(table_metrics_scope, "registry", None)
+  if registry is None:
+    registry = table_metrics_registry
+  with table_metrics_lock:
+    registry.append(table_metrics)
+  return table_metrics
+
+def metrics_summary(registry=table_metrics_registry):
+  with table_metrics_lock:
+    tables = list(registry)
+  summaries = [table_metrics.summary() for table_metrics in tables]
+  for summary in summaries:
+    if summary["status"] == "running":
+      summary["status"] = "incomplete"
+  return {"tables": summaries}
+
+def write_text_file(path, content):
+  # write then rename, so readers never see a partial file
+  if os.path.dirname(path):
+    mkdir_p(os.path.dirname(path))
+  f = open(path + ".tmp", "w+")
+  f.write(content)
+  f.close()
+  os.rename(path + ".tmp", path)
+
+def prometheus_metrics(summary):
+  lines = []
+  for counter in METRIC_COUNTERS + stage_counters():
+    name = "dynamodump_" + counter + "_total"
+    lines.append("# TYPE " + name + " counter")
+    for table in summary["tables"]:
+      lines.append(name + "{table=\"" + table["table"] + "\",operation=\"" + table["operation"] + "\"} " + str(table[counter]))
+      for segment, totals in sorted(table["segments"].items()):
+        lines.append(name + "{table=\"" + table["table"] + "\",operation=\"" + table["operation"] + "\",segment=\"" + segment + "\"} " + str(totals[counter]))
+  lines.append("# TYPE dynamodump_seconds gauge")
+  lines.append("# TYPE dynamodump_expected_items gauge")
+  lines.append("# TYPE dynamodump_completed gauge")
+  for table in summary["tables"]:
+    labels = "{table=\"" + table["table"] + "\",operation=\"" + table["operation"] + "\"} "
+    lines.append("dynamodump_seconds" + labels + str(table["seconds"]))
+    lines.append("dynamodump_expected_items" + labels + str(table["expected_items"] or 0))
+    lines.append("dynamodump_completed" + labels + ("1" if table["status"] == "completed" else "0"))
+  return "\n".join(lines) + "\n"
+
+def report_metrics(metrics_file=None, prometheus_file=None):
+  summary = metrics_summary()
+  if metrics_file:
+    write_text_file(metrics_file, json.dumps(summary, indent=JSON_INDENT))
+  if prometheus_file:
+    write_text_file(prometheus_file, prometheus_metrics(summary))
+
+def report_progress(stop, interval, prometheus_file=None):
+  # logs progress of running tables and refreshes the prometheus textfile until stop is set
+  while not stop.wait(interval):
+    with table_metrics_lock:
+      running = [table_metrics for table_metrics in table_metrics_registry if table_metrics.status == "running"]
+    for table_metrics in running:
+      logging.info(table_metrics.progress())
+    if prometheus_file:
+      report_metrics(prometheus_file=prometheus_file)
+
+def batch_write(conn, table_name, put_requests, rate_limiter=None, table_metrics=None):
   request_items = {table_name: put_requests}
   i = 1
   while True:
-    response = conn.batch_write_item(request_items)
+    if rate_limiter:
+      rate_limiter.acquire()
+    try:
+      response = conn.batch_write_item(request_items, return_consumed_capacity="TOTAL")
+    except boto.exception.JSONResponseError, e:
+      if throughput_exceeded(e):
+        logging.debug("Throughput exceeded writing to " + table_name + ", backing off.. [" + str(i) + "]")
+        if table_metrics:
+          table_metrics.add(requests=1, throttles=1)
+        time.sleep(backoff_delay(i))
+        i += 1
+        continue
+      raise
+
+    if rate_limiter:
+      rate_limiter.consume(consumed_capacity_units(response))
+
     unprocessed_items = response["UnprocessedItems"]
+    unprocessed_count = sum(len(requests) for requests in unprocessed_items.values())
+    if table_metrics:
+      table_metrics.add(requests=1, capacity_units=consumed_capacity_units(response),
+                        unprocessed_items=unprocessed_count, retries=1 if unprocessed_count else 0)
 
     if len(unprocessed_items) == 0:
       break
 
-    if len(unprocessed_items) > 0 and i <= MAX_RETRY:
-      logging.debug(str(len(unprocessed_items)) + " unprocessed items, retrying.. [" + str(i) + "]")
-      request_items = unprocessed_items
-      i += 1
+    # never drop unprocessed items, retry them with an increasing backoff
+    if i <= MAX_RETRY:
+      logging.debug(str(unprocessed_count) + " unprocessed items, retrying.. [" + str(i) + "]")
     else:
-      logging.info("Max retries reached, failed to processed batch write: " + json.dumps(unprocessed_items, indent=JSON_INDENT))
-      logging.info("Ignoring and continuing..")
-      break
+      logging.info(str(unprocessed_count) + " unprocessed items for " + table_name + ", still retrying.. [" + str(i) + "]")
+    request_items = unprocessed_items
+    time.sleep(backoff_delay(i))
+    i += 1
 
-def wait_for_active_table(conn, table_name, verb):
-  while True:
-    if conn.describe_table(table_name)["Table"]["TableStatus"] != "ACTIVE":
-      logging.info("Waiting for " + table_name + " table to be " + verb + ".. [" + conn.describe_table(table_name)["Table"]["TableStatus"] +"]")
-      time.sleep(sleep_interval)
+# encode and decode functions of a JSON codec for data files, "auto" picks ujson when
+# installed. data pages are written without indentation, the stdlib encoder only runs
+# in C without it. items are passed through as decoded, in DynamoDB's wire format.
+def json_codec(name):
+  if name == "auto":
+    name = "ujson" if ujson else "json"
+  if name == "ujson":
+    return name, functools.partial(ujson.dumps, escape_forward_slashes=False), ujson.loads
+  return name, json.dumps, json.loads
+
+json_codec_name, encode_json, decode_json = json_codec("auto")
+
+def iter_file_items(f, dump_format):
+  try:
+    if dump_format == "json":
+      for item in decode_json(f.read())["Items"]:
+        yield item
     else:
-      logging.info(table_name + " " + verb + ".")
+      # one item per line, decompressed a block at a time
+      decompressor = new_decompressor(dump_format)
+      pending = ""
+      while True:
+        block = f.read(READ_BLOCK_SIZE)
+        if not block:
+          break
+        lines = (pending + decompressor.decompress(block)).split("\n")
+        pending = lines.pop()
+        for line in lines:
+          if line:
+            yield decode_json(line)
+      if pending.strip():
+        yield decode_json(pending)
+  finally:
+    f.close()
+
+def iter_data_files(data_path, exclude=(), name_prefix="", table_metrics=None, shard=(0, 1)):
+  data_file_list = [data_file for data_file in os.listdir(data_path)
+                    if data_file_format(data_file) and name_prefix + data_file not in exclude]
+  data_file_list.sort()
+  # shard (index, count) takes every count-th file, starting at index
+  data_file_list = data_file_list[shard[0]::shard[1]]
+
+  for data_file in data_file_list:
+    if table_metrics:
+      table_metrics.add(bytes=os.path.getsize(data_path + "/" + data_file))
+    yield name_prefix + data_file, iter_file_items(open(data_path + "/" + data_file, "rb"), data_file_format(data_file))
+
+def put_until_stopped(queue, item, stopped):
+  # gives up once the consumer has stopped, rather than blocking on a full queue
+  while not stopped.is_set():
+    try:
+      queue.put(item, timeout=1)
+      return True
+    except Queue.Full:
+      pass
+  return False
+
+class Download(object):
+  def __init__(self, key):
+    self.key = key
+    self.done = threading.Event()
+    self.content = None
+    self.error = None
+
+def iter_s3_data_files(s3conn, bucket_id, data_prefix, prefetch, exclude=(), name_prefix="",
+                       table_metrics=None, shard=(0, 1)):
+  if prefetch < 1:
+    raise ValueError("prefetch must be at least 1, no object would be downloaded")
+  keys = [key for key in bucket_id.list(prefix=data_prefix)
+          if data_file_format(key.name) and name_prefix + key.name.rsplit("/", 1)[-1] not in exclude]
+  keys.sort(key=lambda key: key.name)
+  keys = keys[shard[0]::shard[1]]
+
+  # downloads run up to prefetch objects ahead of the consumer, which takes them
+  # in order from a bounded queue
+  downloads = Queue.Queue(maxsize=prefetch)
+  jobs = Queue.Queue()
+  stopped = threading.Event()
+
+  def downloader():
+    bucket = thread_bucket(s3conn, bucket_id)
+    while True:
+      download = jobs.get()
+      if download is None:
+        break
+      try:
+        download.content = Key(bucket, download.key.name).get_contents_as_string()
+      except Exception, e:
+        download.error = e
+      download.done.set()
+
+  def scheduler():
+    for key in keys:
+      download = Download(key)
+      if not put_until_stopped(downloads, download, stopped):
+        break
+      jobs.put(download)
+    put_until_stopped(downloads, None, stopped)
+    for thread in threads:
+      jobs.put(None)
+
+  threads = []
+  for i in range(prefetch):
+    t = threading.Thread(target=downloader)
+    t.daemon = True
+    threads.append(t)
+    t.start()
+  t = threading.Thread(target=scheduler)
+  t.daemon = True
+  t.start()
+
+  try:
+    while True:
+      download = downloads.get()
+      if download is None:
+        break
+      download.done.wait()
+      if download.error is not None:
+        raise download.error
+      data_file = download.key.name.rsplit("/", 1)[-1]
+      if table_metrics:
+        table_metrics.add(bytes=len(download.content))
+      yield name_prefix + data_file, iter_file_items(StringIO(download.content), data_file_format(data_file))
+  finally:
+    stopped.set()
+
+# one destination of a restore, with its own bounded batch queue and pool of batch
+# writers, so every destination applies backpressure on its own queue
+class RestoreTarget(object):
+  def __init__(self, conn, table_name, write_threads, rate_limiter=None, checkpoint=None, table_metrics=None):
+    self.conn = conn
+    self.table_name = table_name
+    self.write_threads = write_threads
+    self.rate_limiter = rate_limiter
+    self.checkpoint = checkpoint
+    self.table_metrics = table_metrics
+    self.batch_queue = Queue.Queue(maxsize=write_threads * 4)
+    self.failures = []
+    self.threads = []
+
+  def start(self):
+    for i in range(self.write_threads):
+      t = threading.Thread(target=self.writer)
+      self.threads.append(t)
+      t.start()
+
+  def writer(self):
+    while True:
+      batch = self.batch_queue.get()
+      if batch is None:
+        break
+      # keep draining after a failure so the reader never blocks on a full queue
+      if len(self.failures) > 0:
+        continue
+      put_requests, data_file, start = batch
+      try:
+        logging.debug("Writing next " + str(len(put_requests)) + " items to " + self.table_name + "..")
+        started = time.time()
+        batch_write(self.conn, self.table_name, put_requests, self.rate_limiter, self.table_metrics)
+        if self.table_metrics:
+          self.table_metrics.add(items=len(put_requests), batch_write_seconds=time.time() - started)
+        if self.checkpoint:
+          self.checkpoint.batch_written(data_file, start, start + len(put_requests))
+      except Exception, e:
+        logging.exception(e)
+        self.failures.append(e)
+
+  def offset(self, data_file):
+    # items of the data file written by a previous run, None once all of them are
+    if not self.checkpoint:
+      return 0
+    if self.checkpoint.completed(data_file):
+      return None
+    return self.checkpoint.offset(data_file)
+
+  def put(self, batch):
+    self.batch_queue.put(batch)
+
+  def close(self):
+    # a target is started and closed once per dump it restores, each start gets new writers
+    for thread in self.threads:
+      self.batch_queue.put(None)
+    for thread in self.threads:
+      thread.join()
+    self.threads = []
+
+# adds the counters to the metrics of several tables at once, e.g. the bytes of a data
+# file read once for every destination of a restore
+class MetricsGroup(object):
+  def __init__(self, table_metrics):
+    self.table_metrics = table_metrics
+
+  def add(self, segment=None, **counts):
+    for table_metrics in self.table_metrics:
+      table_metrics.add(segment, **counts)
+
+def restore_targets(targets, item_pages):
+  # reader stage runs in the calling thread, it decodes every data file once and feeds
+  # the batches to each target still needing them. as target queues are bounded, the
+  # reader advances at the pace of the slowest target.
+  for target in targets:
+    if target.write_threads < 1:
+      raise ValueError("write threads of " + target.table_name + " must be at least 1, no batch would be written")
+  for target in targets:
+    target.start()
+
+  try:
+    for data_file, items in item_pages:
+      healthy = [target for target in targets if len(target.failures) == 0]
+      if len(healthy) == 0:
+        break
+      # per target [target, items to skip, pending batch, position of the batch]
+      pending = [[target, target.offset(data_file), [], 0] for target in healthy]
+      pending = [batch for batch in pending if batch[1] is not None]
+      if len(pending) == 0:
+        continue
+      logging.info("Processing " + data_file + " of " + ", ".join([batch[0].table_name for batch in pending]))
+
+      # skip items already written by a previous run
+      position = min([batch[1] for batch in pending])
+      for batch in pending:
+        batch[3] = batch[1]
+        if batch[1] > 0:
+          logging.info("Resuming " + data_file + " of " + batch[0].table_name + " after " + str(batch[1]) + " items")
+      if position > 0:
+        items = itertools.islice(items, position, None)
+
+      # parse time is the time spent reading items, not waiting on the writers
+      started = time.time()
+      waited = 0
+      for item in items:
+        put_request = {"PutRequest": {"Item": item}}
+        for batch in pending:
+          if position < batch[1]:
+            continue
+          batch[2].append(put_request)
+
+          # flush every MAX_BATCH_WRITE
+          if len(batch[2]) == MAX_BATCH_WRITE:
+            waiting = time.time()
+            batch[0].put((batch[2], data_file, batch[3]))
+            waited += time.time() - waiting
+            batch[2] = []
+            batch[3] = position + 1
+        position += 1
+
+      parse_seconds = time.time() - started - waited
+      for target, skipped, put_requests, start in pending:
+        # flush remainder
+        if len(put_requests) > 0:
+          target.put((put_requests, data_file, start))
+        if target.table_metrics:
+          target.table_metrics.add(parse_seconds=parse_seconds)
+        if target.checkpoint:
+          target.checkpoint.file_read(data_file, position)
+  finally:
+    for target in targets:
+      target.close()
+
+def restore_items(conn, table_name, item_pages, write_threads,
+                  rate_limiter=None, checkpoint=None, table_metrics=None):
+  target = RestoreTarget(conn, table_name, write_threads, rate_limiter, checkpoint, table_metrics)
+  restore_targets([target], item_pages)
+  return target.failures
+
+# stands in for the parent's RestoreCheckpoint of a target in a restore process, the
+# parent owns the checkpoint file and applies the progress forwarded to it
+class ForwardedCheckpoint(object):
+  def __init__(self, index, completed_files, offsets, events):
+    self.index = index
+    self.completed_files = completed_files
+    self.offsets = offsets
+    self.events = events
+
+  def completed(self, data_file):
+    return data_file in self.completed_files
+
+  def offset(self, data_file):
+    return self.offsets.get(data_file, 0)
+
+  def batch_written(self, data_file, start, end):
+    self.events.put(("batch_written", (self.index, data_file, start, end)))
+
+  def file_read(self, data_file, total):
+    self.events.put(("file_read", (self.index, data_file, total)))
+
+def forward_metrics(metrics_list, events, stop):
+  # sends the counters added to each target since the last report until stop is set
+  sent = [dict(table_metrics.totals) for table_metrics in metrics_list]
+  while True:
+    stopping = stop.wait(PROCESS_REPORT_INTERVAL)
+    for index, table_metrics in enumerate(metrics_list):
+      with table_metrics.lock:
+        totals = dict(table_metrics.totals)
+      counts = dict((counter, totals[counter] - sent[index][counter]) for counter in totals if totals[counter] != sent[index][counter])
+      if counts:
+        events.put(("metrics", (index, counts)))
+      sent[index] = totals
+    if stopping:
       break
 
+def logging_locks(acquire):
+  # logging locks are held across fork, so no restore process starts with a lock
+  # taken by a thread that does not exist in it
+  handlers = logging.getLogger().handlers
+  if acquire:
+    logging._acquireLock()
+    for handler in handlers:
+      handler.acquire()
+  else:
+    for handler in handlers:
+      handler.release()
+    logging._releaseLock()
+
+def restore_process(events, shard, conn, target_states, s3conn, bucket_name, path, name_prefix,
+                    exclude, write_threads, s3_prefetch):
+  logging_locks(False)
+  # forked processes inherit the parent's random state, reseed so their backoff jitter differs
+  random.seed()
+  # connections of the parent are not shared with the process, it opens its own
+  if isinstance(conn, ConnectionPool):
+    conn = ConnectionPool(conn.factory, conn.max_size)
+  targets = []
+  for index, (table_name, rate_limiter, completed_files, offsets) in enumerate(target_states):
+    targets.append(RestoreTarget(conn, table_name, write_threads, rate_limiter,
+                                 ForwardedCheckpoint(index, completed_files, offsets, events),
+                                 TableMetrics(table_name, "restore")))
+  metrics_list = [target.table_metrics for target in targets]
+  stop = threading.Event()
+  reporter = threading.Thread(target=forward_metrics, args=(metrics_list, events, stop))
+  reporter.start()
+  try:
+    if bucket_name:
+      if isinstance(s3conn, ConnectionPool):
+        s3conn = ConnectionPool(s3conn.factory, s3conn.max_size)
+      bucket_id = s3conn.get_bucket(bucket_name, validate=False)
+      item_pages = iter_s3_data_files(s3conn, bucket_id, path + "/" + DATA_DIR + "/", s3_prefetch,
+                                      exclude, name_prefix, MetricsGroup(metrics_list), shard)
+    else:
+      item_pages = iter_data_files(path + "/" + DATA_DIR, exclude, name_prefix, MetricsGroup(metrics_list), shard)
+    restore_targets(targets, item_pages)
+  except Exception, e:
+    logging.exception(e)
+    for target in targets:
+      target.failures.append(e)
+  stop.set()
+  reporter.join()
+  failures = [(index, str(failure)) for index, target in enumerate(targets) for failure in target.failures]
+  events.put(("done", (shard[0], failures)))
+
+def restore_processes(conn, targets, s3conn, bucket_id, path, name_prefix, exclude, processes,
+                      write_threads, s3_prefetch):
+  # data files are sharded over forked processes, each with its own connections and
+  # batch writers for every target. the parent applies the checkpoint progress,
+  # metrics and failures they send to its targets.
+  events = multiprocessing.Queue()
+  bucket_name = None
+  if bucket_id:
+    bucket_name = bucket_id.name
+  target_states = [(target.table_name, target.rate_limiter, list(target.checkpoint.state["CompletedFiles"]),
+                    dict(target.checkpoint.state["Offsets"])) for target in targets]
+  workers = []
+  for i in range(processes):
+    workers.append(multiprocessing.Process(target=restore_process,
+                                           args=(events, (i, processes), conn, target_states,
+                                                 s3conn, bucket_name, path, name_prefix, exclude,
+                                                 write_threads, s3_prefetch)))
+  logging_locks(True)
+  try:
+    for worker in workers:
+      worker.start()
+  finally:
+    logging_locks(False)
+
+  done = set()
+  exited = set()
+  while len(done) < processes:
+    try:
+      event, value = events.get(timeout=1)
+    except Queue.Empty:
+      # a process that exited without reporting, e.g. killed. a process flushes its events
+      # before exiting, so it only failed if the queue is still empty at the next poll
+      for i, worker in enumerate(workers):
+        if i in done or worker.is_alive():
+          continue
+        if i not in exited:
+          exited.add(i)
+          continue
+        done.add(i)
+        for target in targets:
+          target.failures.append("restore process " + str(i) + " exited with code " + str(worker.exitcode) + " without reporting")
+      continue
+    if event == "metrics":
+      targets[value[0]].table_metrics.add(**value[1])
+    elif event == "done":
+      done.add(value[0])
+      for index, failure in value[1]:
+        targets[index].failures.append(failure)
+    else:
+      getattr(targets[value[0]].checkpoint, event)(*value[1:])
+  for worker in workers:
+    worker.join()
+
+def table_status(table_desc):
+  # the table status, or that of the first GSI not ACTIVE while the table is, as index
+  # backfills keep running after the table itself is ACTIVE again
+  status = table_desc["TableStatus"]
+  for gsi in table_desc.get("GlobalSecondaryIndexes", []):
+    if status == "ACTIVE" and gsi["IndexStatus"] != "ACTIVE":
+      status = gsi["IndexName"] + " " + gsi["IndexStatus"]
+  return status
+
+# polls the status of every table that threads wait on from one thread, each table once
+# per round however many threads wait on it, and at most WATCH_POLL_RATE calls a second
+# overall. polls of a table back off from WATCH_MIN_INTERVAL to WATCH_MAX_INTERVAL, so
+# quick changes resolve within a second while long ones do not flood the control plane.
+class TableStatusWatcher(object):
+  def __init__(self, conn):
+    self.conn = conn
+    self.condition = threading.Condition()
+    self.tables = {}
+    self.rate_limiter = TokenBucket(WATCH_POLL_RATE)
+    self.thread = None
+
+  def wait(self, table_name, state, verb):
+    # blocks until the table is "active" with all its GSIs, "deleted", or "settled" in
+    # either of those states
+    waiter = {"state": state, "verb": verb, "done": threading.Event(), "error": None}
+    with self.condition:
+      if table_name not in self.tables:
+        # status is the last one logged, the empty string before the first poll
+        self.tables[table_name] = {"waiters": [], "next_poll": time.time(), "interval": WATCH_MIN_INTERVAL,
+                                   "status": "", "not_found": 0}
+      self.tables[table_name]["waiters"].append(waiter)
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+      self.condition.notify()
+    waiter["done"].wait()
+    if waiter["error"] is not None:
+      logging.exception(waiter["error"])
+      sys.exit(1)
+
+  def run(self):
+    while True:
+      with self.condition:
+        now = time.time()
+        due = [table_name for table_name, table in self.tables.items() if table["next_poll"] <= now]
+        if len(due) == 0:
+          timeout = None
+          if len(self.tables) > 0:
+            timeout = min(table["next_poll"] for table in self.tables.values()) - now
+          self.condition.wait(timeout)
+          continue
+
+      for table_name in due:
+        self.rate_limiter.acquire()
+        self.rate_limiter.consume(1)
+        error = None
+        not_found = None
+        throttled = False
+        try:
+          status = table_status(self.conn.describe_table(table_name)["Table"])
+        except boto.exception.JSONResponseError, e:
+          status = None
+          if e.body["__type"] == "com.amazonaws.dynamodb.v20120810#LimitExceededException" or \
+              e.body["__type"] == "com.amazon.coral.availability#ThrottlingException":
+            throttled = True
+          elif e.body["__type"] == "com.amazonaws.dynamodb.v20120810#ResourceNotFoundException":
+            not_found = e
+          else:
+            error = e
+        except Exception, e:
+          status = None
+          error = e
+        with self.condition:
+          self.update(table_name, status, throttled, error, not_found)
+
+  def update(self, table_name, status, throttled, error, not_found=None):
+    table = self.tables[table_name]
+    if not_found is not None:
+      table["not_found"] += 1
+    elif not throttled:
+      table["not_found"] = 0
+    waiting = []
+    for waiter in table["waiters"]:
+      reached = not throttled and (status is None and waiter["state"] != "active" or
+                                   status == "ACTIVE" and waiter["state"] != "deleted")
+      # a table still missing after a few polls is not going to become active
+      missing = waiter["state"] == "active" and table["not_found"] >= WATCH_NOT_FOUND_POLLS
+      if missing:
+        logging.error(table_name + " table not found after " + str(table["not_found"]) + " polls, it cannot be " + waiter["verb"])
+        waiter["error"] = not_found
+        waiter["done"].set()
+        continue
+      if error is not None or reached:
+        waiter["error"] = error
+        waiter["done"].set()
+        continue
+      if not throttled and status != table["status"]:
+        logging.info("Waiting for " + table_name + " table to be " + waiter["verb"] + ".. [" + str(status or "NOT FOUND") + "]")
+      waiting.append(waiter)
+    if len(waiting) == 0:
+      del self.tables[table_name]
+      return
+    table["waiters"] = waiting
+    if not throttled:
+      table["status"] = status
+    table["next_poll"] = time.time() + table["interval"]
+    table["interval"] = min(table["interval"] * 2, WATCH_MAX_INTERVAL)
+
+table_watchers = {}
+table_watchers_lock = threading.Lock()
+
+def table_watcher(conn):
+  # one watcher per connection, shared by every thread using it
+  with table_watchers_lock:
+    if id(conn) not in table_watchers:
+      table_watchers[id(conn)] = TableStatusWatcher(conn)
+    return table_watchers[id(conn)]
+
+def wait_for_active_table(conn, table_name, verb):
+  table_watcher(conn).wait(table_name, "active", verb)
+  logging.info(table_name + " " + verb + ".")
+
 def update_provisioned_throughput(conn, table_name, read_capacity, write_capacity, wait=True):
   logging.info("Updating " + table_name + " table read capacity to: " + str(read_capacity) + ", write capacity to: " + str(write_capacity))
+  update_table(conn, table_name,
+               provisioned_throughput={"ReadCapacityUnits": int(read_capacity), "WriteCapacityUnits": int(write_capacity)})
+
+  # wait for provisioned throughput update completion
+  if wait:
+    wait_for_active_table(conn, table_name, "updated")
+
+def update_table(conn, table_name, **updates):
+  # UpdateTable, retried with backoff while the control plane is busy
+  attempt = 1
   while True:
     try:
-      conn.update_table(table_name, {"ReadCapacityUnits": int(read_capacity), "WriteCapacityUnits": int(write_capacity)})
+      conn.update_table(table_name, **updates)
       break
     except boto.exception.JSONResponseError, e:
       if e.body["__type"] == "com.amazonaws.dynamodb.v20120810#LimitExceededException":
-        logging.info("Limit exceeded, retrying updating throughput of " + table_name + "..")
-        time.sleep(sleep_interval)
+        logging.info("Limit exceeded, retrying update of " + table_name + "..")
       elif e.body["__type"] == "com.amazon.coral.availability#ThrottlingException":
-        logging.info("Control plane limit exceeded, retrying updating throughput of " + table_name + "..")
-        time.sleep(sleep_interval)
-
-  # wait for provisioned throughput update completion
-  if wait:
-    wait_for_active_table(conn, table_name, "updated")
+        logging.info("Control plane limit exceeded, retrying update of " + table_name + "..")
+      else:
+        logging.exception(e)
+        sys.exit(1)
+      time.sleep(backoff_delay(attempt))
+      attempt += 1
+
+def capacity_update(table_desc, read_capacity, write_capacity, gsi_capacities={}):
+  # UpdateTable arguments moving a table and its GSIs to the given capacities in a single
+  # call, gsi_capacities maps index names to (read, write). capacities already in place
+  # are left out, as DynamoDB rejects updates that change nothing.
+  updates = {}
+  throughput = table_desc["ProvisionedThroughput"]
+  if int(read_capacity) != throughput["ReadCapacityUnits"] or int(write_capacity) != throughput["WriteCapacityUnits"]:
+    updates["provisioned_throughput"] = {"ReadCapacityUnits": int(read_capacity), "WriteCapacityUnits": int(write_capacity)}
+  gsi_updates = []
+  for gsi in table_desc.get("GlobalSecondaryIndexes", []):
+    if gsi["IndexName"] not in gsi_capacities:
+      continue
+    read, write = gsi_capacities[gsi["IndexName"]]
+    if int(read) != gsi["ProvisionedThroughput"]["ReadCapacityUnits"] or int(write) != gsi["ProvisionedThroughput"]["WriteCapacityUnits"]:
+      gsi_updates.append({"Update": {"IndexName": gsi["IndexName"],
+                                     "ProvisionedThroughput": {"ReadCapacityUnits": int(read), "WriteCapacityUnits": int(write)}}})
+  if len(gsi_updates) > 0:
+    updates["global_secondary_index_updates"] = gsi_updates
+  return updates
+
+def key_attribute_definitions(attribute_definitions, key_schemas):
+  # the attribute definitions used by the given key schemas, DynamoDB rejects any other
+  names = set(key["AttributeName"] for key_schema in key_schemas for key in key_schema)
+  return [definition for definition in attribute_definitions if definition["AttributeName"] in names]
+
+def create_next_index(conn, table_name, attribute_definitions, key_schemas, gsis):
+  # requests the first of gsis missing from the table, DynamoDB creates one index per
+  # UpdateTable call. returns False once every index exists.
+  existing = [gsi["IndexName"] for gsi in conn.describe_table(table_name)["Table"].get("GlobalSecondaryIndexes", [])]
+  missing = [gsi for gsi in gsis if gsi["IndexName"] not in existing]
+  if len(missing) == 0:
+    return False
+  gsi = missing[0]
+  logging.info("Creating global secondary index " + gsi["IndexName"] + " of " + table_name + "..")
+  created = [created_gsi["KeySchema"] for created_gsi in gsis if created_gsi["IndexName"] in existing]
+  create = {"IndexName": gsi["IndexName"], "KeySchema": gsi["KeySchema"], "Projection": gsi["Projection"],
+            "ProvisionedThroughput": {"ReadCapacityUnits": int(gsi["ProvisionedThroughput"]["ReadCapacityUnits"]),
+                                      "WriteCapacityUnits": int(gsi["ProvisionedThroughput"]["WriteCapacityUnits"])}}
+  update_table(conn, table_name,
+               attribute_definitions=key_attribute_definitions(attribute_definitions, key_schemas + created + [gsi["KeySchema"]]),
+               global_secondary_index_updates=[{"Create": create}])
+  return True
+
+# hands every thread its own connection, created on first use, so concurrent workers
+# get their own keep-alive HTTP connection instead of serializing on a shared one.
+# attribute lookups are forwarded to the calling thread's connection, so a pool can
+# be passed anywhere a connection is expected. once max_size connections exist,
+# further threads share them round-robin.
+class ConnectionPool(object):
+  def __init__(self, factory, max_size=CONNECTION_POOL_SIZE):
+    self.factory = factory
+    self.max_size = max_size
+    self.connections = []
+    self.next_shared = 0
+    self.local = threading.local()
+    self.lock = threading.Lock()
+
+  def connection(self):
+    conn = getattr(self.local, "connection", None)
+    if conn is None:
+      with self.lock:
+        if len(self.connections) < self.max_size:
+          conn = self.factory()
+          self.connections.append(conn)
+        else:
+          conn = self.connections[self.next_shared % len(self.connections)]
+          self.next_shared += 1
+      self.local.connection = conn
+    return conn
+
+  def __getattr__(self, name):
+    return getattr(self.connection(), name)
+
+def thread_bucket(s3conn, bucket_id):
+  # the bucket bound to the calling thread's connection
+  if isinstance(s3conn, ConnectionPool):
+    return s3conn.get_bucket(bucket_id.name, validate=False)
+  return bucket_id
 
-def connect_to_s3():
-  conn = S3Connection()
+def connect_to_s3(host=None, port=None):
+  if host:
+    # S3 compatible stand-in, e.g. moto_server
+    conn = S3Connection(host=host, port=port, is_secure=False,
+                        calling_format=OrdinaryCallingFormat())
+  else:
+    conn = S3Connection()
 
   return conn
 
+def connect(region, host=None, port=None, access_key=None, secret_key=None,
+            max_connections=CONNECTION_POOL_SIZE):
+  # pool of DynamoDB connections to region, or to DynamoDB Local at host and port
+  if region == LOCAL_REGION:
+    conn_factory = functools.partial(DynamoDBConnection,
+      aws_access_key_id=access_key,
+      aws_secret_access_key=secret_key,
+      host=host,
+      port=int(port),
+      is_secure=False
+    )
+  else:
+    conn_factory = functools.partial(boto.dynamodb2.connect_to_region,
+      region,
+      aws_access_key_id=access_key,
+      aws_secret_access_key=secret_key
+    )
+  return ConnectionPool(conn_factory, max_connections)
+
+def region_sleep_interval(region):
+  if region == LOCAL_REGION:
+    return LOCAL_SLEEP_INTERVAL
+  return AWS_SLEEP_INTERVAL
+
 def create_s3_bucket(conn, region, bucket):
   try:
     bucket_id = conn.create_bucket(bucket)
@@ -190,41 +1306,686 @@ def s3_file_write(conn, bucket_id, content, path):
   k.key = path
   k.set_contents_from_string(content)
 
+def s3_file_write_from_file(conn, bucket_id, fp, path):
+  k = Key(bucket_id)
+  logging.info("Creating file: %s" % (path))
+  k.key = path
+  k.set_contents_from_file(fp, rewind=True)
+
+def s3_multipart_write_from_file(conn, bucket_id, fp, path):
+  logging.info("Creating file: %s (multipart)" % (path))
+  fp.seek(0)
+  mp = bucket_id.initiate_multipart_upload(path)
+  try:
+    part_num = 1
+    while True:
+      data = fp.read(S3_MULTIPART_CHUNK_SIZE)
+      if not data:
+        break
+      mp.upload_part_from_file(StringIO(data), part_num)
+      part_num += 1
+    mp.complete_upload()
+  except:
+    mp.cancel_upload()
+    raise
+
+# background upload queue, writers hand over objects and carry on scanning while a
+# pool of threads uploads them. upload() blocks once the objects waiting to be
+# uploaded exceed memory_limit bytes, which bounds memory and spooled disk use.
+class S3Uploader(object):
+  def __init__(self, s3conn, bucket_id, threads=S3_UPLOAD_THREADS,
+               memory_limit=S3_UPLOAD_MEMORY * 1024 * 1024):
+    self.s3conn = s3conn
+    self.bucket_id = bucket_id
+    self.memory_limit = memory_limit
+    self.pending_bytes = 0
+    self.condition = threading.Condition()
+    self.queue = Queue.Queue()
+    self.failures = []
+    self.threads = []
+    for i in range(threads):
+      t = threading.Thread(target=self._worker)
+      t.daemon = True
+      self.threads.append(t)
+      t.start()
+
+  def upload(self, path, content, on_done=None):
+    self.upload_file(path, StringIO(content), len(content), on_done)
+
+  def upload_file(self, path, fp, size, on_done=None):
+    # takes ownership of fp and closes it once uploaded, on_done is called after
+    # a successful upload
+    with self.condition:
+      while self.pending_bytes > 0 and self.pending_bytes + size > self.memory_limit:
+        self.condition.wait()
+      self.pending_bytes += size
+    self.queue.put((path, fp, size, on_done))
+
+  def _worker(self):
+    bucket_id = thread_bucket(self.s3conn, self.bucket_id)
+    while True:
+      job = self.queue.get()
+      if job is None:
+        break
+      path, fp, size, on_done = job
+      try:
+        if size >= S3_MULTIPART_THRESHOLD:
+          s3_multipart_write_from_file(self.s3conn, bucket_id, fp, path)
+        else:
+          s3_file_write_from_file(self.s3conn, bucket_id, fp, path)
+        if on_done:
+          on_done()
+      except Exception, e:
+        logging.exception(e)
+        self.failures.append(path)
+      finally:
+        fp.close()
+        with self.condition:
+          self.pending_bytes -= size
+          self.condition.notify_all()
+
+  def close(self):
+    # wait for queued uploads to drain, returns the paths that failed to upload
+    for thread in self.threads:
+      self.queue.put(None)
+    for thread in self.threads:
+      thread.join()
+    return self.failures
+
 def s3_file_read(conn, bucket_id, path):
-  content = bucket_id.get_contents_as_string(path)
+  content = bucket_id.get_key(path).get_contents_as_string()
 
   return content
 
+def data_file_name(page, segment=None, dump_format="json"):
+  if segment is None:
+    return str(page).zfill(4) + "." + dump_format
+  return str(segment).zfill(4) + "-" + str(page).zfill(4) + "." + dump_format
+
+def data_file_format(data_file):
+  for dump_format in DUMP_FORMATS:
+    if data_file.endswith("." + dump_format):
+      return dump_format
+  return None
+
+def new_compressor(dump_format):
+  if dump_format == "ndjson.zst":
+    if zstandard is None:
+      raise ImportError("zstandard is required to write .zst dumps")
+    return zstandard.ZstdCompressor().compressobj()
+  # wbits of 16 + MAX_WBITS writes a gzip container
+  return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def new_decompressor(dump_format):
+  if dump_format == "ndjson.zst":
+    if zstandard is None:
+      raise ImportError("zstandard is required to read .zst dumps")
+    return zstandard.ZstdDecompressor().decompressobj()
+  return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def parse_data_file_name(data_file):
+  # returns (segment, number), segment is None for unsegmented dumps
+  name = data_file.split(".", 1)[0]
+  if "-" in name:
+    segment, number = name.split("-", 1)
+    return int(segment), int(number)
+  return None, int(name)
+
+# manifests list every data file of a dump with its item count, stored size and sha256,
+# and the lowest and highest primary key in it, ordered by hash key then range key
+def key_names(key_schema):
+  return [key["AttributeName"] for key in sorted(key_schema, key=lambda key: key["KeyType"] != "HASH")]
+
+def key_value(attribute_value):
+  if "N" in attribute_value:
+    return decimal.Decimal(attribute_value["N"])
+  if "B" in attribute_value:
+    return base64.b64decode(attribute_value["B"])
+  return attribute_value["S"]
+
+def merge_key_range(key_range, items, names):
+  # widens key_range to the keys of items, None until there are any
+  if not names:
+    return key_range
+  candidates = list(items)
+  if key_range is not None:
+    candidates.extend([key_range["Min"], key_range["Max"]])
+  if len(candidates) == 0:
+    return key_range
+  sort_key = lambda item: [key_value(item[name]) for name in names]
+  lowest = min(candidates, key=sort_key)
+  highest = max(candidates, key=sort_key)
+  return {"Min": dict((name, lowest[name]) for name in names),
+          "Max": dict((name, highest[name]) for name in names)}
+
+def manifest_entry(items, stored_bytes, digest, key_range):
+  entry = {"Items": items, "Bytes": stored_bytes, "Sha256": digest.hexdigest()}
+  if key_range is not None:
+    entry["KeyRange"] = key_range
+  return entry
+
+def dump_manifest(table_name, state, key_schema):
+  files = state.get("Files", {})
+  names = key_names(key_schema)
+  key_range = None
+  for entry in files.values():
+    if "KeyRange" in entry:
+      key_range = merge_key_range(key_range, [entry["KeyRange"]["Min"], entry["KeyRange"]["Max"]], names)
+  manifest = {"Table": table_name, "Format": state["Format"], "TotalSegments": state["TotalSegments"],
+              "StartTime": state["StartTime"], "KeySchema": key_schema,
+              "Items": sum([entry["Items"] for entry in files.values()]),
+              "Bytes": sum([entry["Bytes"] for entry in files.values()]),
+              "KeyRange": key_range, "Files": files}
+  if "Subset" in state:
+    manifest["Subset"] = state["Subset"]
+  return manifest
+
+def write_dump_file(uploader, path, content, on_done=None):
+  if uploader:
+    uploader.upload(path, content, on_done)
+  else:
+    mkdir_p(os.path.dirname(path))
+    f = open(path, "w+")
+    f.write(content)
+    f.close()
+    if on_done:
+      on_done()
+
+def write_json_file(path, state, uploader=None):
+  content = json.dumps(state, indent=JSON_INDENT)
+  if uploader:
+    s3_file_write(uploader.s3conn, uploader.bucket_id, content, path)
+  else:
+    write_text_file(path, content)
+
+def read_json_file(path, bucket_id=None):
+  if bucket_id:
+    if bucket_id.get_key(path) is None:
+      return None
+    return json.loads(s3_file_read(None, bucket_id, path))
+  if not os.path.exists(path):
+    return None
+  f = open(path)
+  state = json.load(f)
+  f.close()
+  return state
+
+def remove_dump_path(path, bucket_id=None):
+  if bucket_id:
+    # one multi-object delete per MAX_S3_DELETE keys rather than a request per key
+    key_names = [key.name for key in bucket_id.list(prefix=path + "/")]
+    for i in xrange(0, len(key_names), MAX_S3_DELETE):
+      result = bucket_id.delete_keys(key_names[i:i + MAX_S3_DELETE], quiet=True)
+      if len(result.errors) > 0:
+        logging.error("Could not remove " + str(len(result.errors)) + " object(s) of " + path + ", e.g. " + result.errors[0].key + ": " + str(result.errors[0].message))
+        sys.exit(1)
+  elif os.path.exists(path):
+    shutil.rmtree(path)
+
+def list_deltas(table_path, bucket_id=None):
+  # complete deltas in replay order, a delta is complete once its snapshot file exists
+  delta_path = table_path + "/" + DELTA_DIR
+  if bucket_id:
+    deltas = [entry.name[len(delta_path) + 1:].rstrip("/") for entry in bucket_id.list(prefix=delta_path + "/", delimiter="/")]
+  elif os.path.exists(delta_path):
+    deltas = os.listdir(delta_path)
+  else:
+    deltas = []
+
+  complete_deltas = []
+  for delta in sorted(deltas):
+    snapshot = read_json_file(delta_path + "/" + delta + "/" + SNAPSHOT_FILE, bucket_id)
+    if snapshot is None:
+      break
+    complete_deltas.append((delta, snapshot))
+  return complete_deltas
+
+def locate_dump(source_table, s3conn, s3bucket, dump_path):
+  # returns (bucket_id, table_path) of the dump of source_table, bucket_id is None for local dumps
+  if s3bucket:
+    try:
+      bucket_id = s3conn.get_bucket(s3bucket)
+    except boto.exception.S3ResponseError:
+      logging.info("Bucket: %s does not exist" % s3bucket)
+      sys.exit(1)
+
+    table_path = dump_path + "/" + source_table
+    if bucket_id.get_key(table_path + "/" + SCHEMA_FILE) is None:
+      logging.info("Cannot find \"%s/%s\" in bucket %s containing dump files!" % (table_path, SCHEMA_FILE, s3bucket))
+      sys.exit(1)
+    return bucket_id, table_path
+
+  # use source_table from dump directory if it exists else try current working directory
+  if os.path.exists("%s/%s" % (dump_path, source_table)):
+    return None, dump_path + "/" + source_table
+  logging.info("Cannot find \"./%s/%s\", Now trying current working directory.." % (dump_path, source_table))
+  if os.path.exists("%s/%s" % (CURRENT_WORKING_DIR, source_table)):
+    return None, CURRENT_WORKING_DIR + "/" + source_table
+  logging.info("Cannot find \"%s/%s\" directory containing dump files!" % (CURRENT_WORKING_DIR, source_table))
+  sys.exit(1)
+
+def list_dumps(table_path, bucket_id=None):
+  # (data file name prefix, path) of the base dump and each complete delta in replay order
+  dumps = [("", table_path)]
+  for delta, snapshot in list_deltas(table_path, bucket_id):
+    dumps.append((DELTA_DIR + "/" + delta + "/", table_path + "/" + DELTA_DIR + "/" + delta))
+  return dumps
+
+def format_timestamp(timestamp, timestamp_format):
+  # DynamoDB attribute value for the update timestamp of items changed since timestamp
+  if timestamp_format == "epoch_ms":
+    return {"N": str(int(timestamp * 1000))}
+  if timestamp_format == "iso8601":
+    return {"S": datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%SZ")}
+  return {"N": str(int(timestamp))}
+
+def remove_stale_files(table_path, uploader, segment, last_file):
+  # files numbered past the checkpoint may be partial, they are rewritten on resume
+  data_path = table_path + "/" + DATA_DIR
+  if uploader:
+    data_files = [(key.name.rsplit("/", 1)[-1], key) for key in uploader.bucket_id.list(prefix=data_path + "/")]
+  elif os.path.exists(data_path):
+    data_files = [(data_file, data_path + "/" + data_file) for data_file in os.listdir(data_path)]
+  else:
+    data_files = []
+
+  for data_file, location in data_files:
+    if not data_file_format(data_file):
+      continue
+    file_segment, number = parse_data_file_name(data_file)
+    if file_segment == segment and number > last_file:
+      logging.info("Removing partial file " + data_file + " of " + table_path)
+      if uploader:
+        location.delete()
+      else:
+        os.remove(location)
+
+# streams items one per line into compressed chunk files, the caller closes a chunk
+# between scan pages once MAX_CHUNK_SIZE bytes of items have been written
+class ChunkWriter(object):
+  def __init__(self, table_path, uploader, dump_format, segment=None, first_chunk=1, key_names=()):
+    self.table_path = table_path
+    self.uploader = uploader
+    self.dump_format = dump_format
+    self.segment = segment
+    self.key_names = key_names
+    self.chunk = first_chunk - 1
+    self.f = None
+
+  def _open(self):
+    self.chunk += 1
+    self.path = self.table_path + "/" + DATA_DIR + "/" + data_file_name(self.chunk, self.segment, self.dump_format)
+    if self.uploader:
+      # spool the chunk locally, it is uploaded once complete
+      self.f = tempfile.TemporaryFile()
+    else:
+      mkdir_p(os.path.dirname(self.path))
+      self.f = open(self.path, "wb")
+    self.compressor = new_compressor(self.dump_format)
+    self.size = 0
+    self.items = 0
+    self.stored = 0
+    self.digest = hashlib.sha256()
+    self.key_range = None
+
+  def _write(self, data):
+    self.f.write(data)
+    self.stored += len(data)
+    self.digest.update(data)
+
+  def write(self, lines, items):
+    # lines holds the page's items serialized one per line
+    if self.f is None:
+      self._open()
+    self._write(self.compressor.compress(lines))
+    self.size += len(lines)
+    self.items += len(items)
+    self.key_range = merge_key_range(self.key_range, items, self.key_names)
+
+  def close(self, on_done=None):
+    # on_done is called with the manifest entry of the chunk once it is written
+    self._write(self.compressor.flush())
+    if on_done:
+      on_done = functools.partial(on_done, manifest_entry(self.items, self.stored, self.digest, self.key_range))
+    if self.uploader:
+      self.uploader.upload_file(self.path, self.f, self.f.tell(), on_done)
+    else:
+      self.f.close()
+      if on_done:
+        on_done()
+    self.f = None
+
+# per segment record of the last data file known to be written and the scan key to
+# continue from after it, persisted to <table>/checkpoint.json
+class BackupCheckpoint(object):
+  def __init__(self, path, state, uploader=None):
+    self.path = path
+    self.state = state
+    self.uploader = uploader
+    self.lock = threading.Lock()
+    self.pending = {}
+    self.last_save = 0
+
+  def segment_state(self, segment):
+    with self.lock:
+      return self.state["Segments"].setdefault(str(segment or 0), {"File": 0, "LastEvaluatedKey": None, "Items": 0, "Done": False})
+
+  def file_written(self, segment, file_number, last_evaluated_key, entry):
+    segment_state = self.segment_state(segment)
+    with self.lock:
+      # uploads can finish out of order, only advance over files written in sequence
+      pending = self.pending.setdefault(str(segment or 0), {})
+      pending[file_number] = (last_evaluated_key, entry)
+      while segment_state["File"] + 1 in pending:
+        last_evaluated_key, entry = pending.pop(segment_state["File"] + 1)
+        segment_state["File"] += 1
+        segment_state["LastEvaluatedKey"] = last_evaluated_key
+        segment_state["Items"] += entry["Items"]
+        segment_state["Done"] = last_evaluated_key is None
+        # manifest entries of the files written so far, kept with the checkpoint for resumes
+        self.state.setdefault("Files", {})[data_file_name(segment_state["File"], segment, self.state["Format"])] = entry
+      self._save(segment_state["Done"])
+
+  def save(self):
+    with self.lock:
+      self._save(True)
+
+  def _save(self, force):
+    if not force and time.time() - self.last_save < CHECKPOINT_INTERVAL:
+      return
+    self.last_save = time.time()
+    write_json_file(self.path, self.state, self.uploader)
+
+# per data file count of items written in sequence and the list of fully restored
+# files, persisted under CHECKPOINT_DIR
+class RestoreCheckpoint(object):
+  def __init__(self, path, state):
+    self.path = path
+    self.state = state
+    self.lock = threading.Lock()
+    self.pending = {}
+    self.totals = {}
+    self.last_save = 0
+
+  def completed(self, data_file):
+    with self.lock:
+      return data_file in self.state["CompletedFiles"]
+
+  def offset(self, data_file):
+    with self.lock:
+      return self.state["Offsets"].get(data_file, 0)
+
+  def batch_written(self, data_file, start, end):
+    with self.lock:
+      # writers finish batches out of order, only advance over items written in sequence
+      pending = self.pending.setdefault(data_file, {})
+      pending[start] = end
+      offset = self.state["Offsets"].get(data_file, 0)
+      while offset in pending:
+        offset = pending.pop(offset)
+      self.state["Offsets"][data_file] = offset
+      self._complete(data_file)
+      self._save(False)
+
+  def file_read(self, data_file, total):
+    with self.lock:
+      self.totals[data_file] = total
+      self._complete(data_file)
+      self._save(False)
+
+  def _complete(self, data_file):
+    if self.totals.get(data_file) == self.state["Offsets"].get(data_file, 0):
+      self.state["CompletedFiles"].append(data_file)
+      self.state["Offsets"].pop(data_file, None)
+      self.pending.pop(data_file, None)
+      del self.totals[data_file]
+
+  def save(self):
+    with self.lock:
+      self._save(True)
+
+  def _save(self, force):
+    if not force and time.time() - self.last_save < CHECKPOINT_INTERVAL:
+      return
+    self.last_save = time.time()
+    write_json_file(self.path, self.state)
+
+  def remove(self):
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+def scan_expressions(filter_expression=None, projection_expression=None,
+                     attribute_names=None, attribute_values=None, key_names=()):
+  # scan keyword arguments of a subset backup. key attributes are added to a projection
+  # that leaves them out, as restores cannot write items without them
+  options = {}
+  names = dict(attribute_names or {})
+  values = dict(attribute_values or {})
+  if filter_expression:
+    options["filter_expression"] = filter_expression
+  if projection_expression:
+    projected = [names.get(name, name) for name in
+                 [re.split(r"[.\[]", path.strip(), 1)[0] for path in projection_expression.split(",")]]
+    for i, name in enumerate(key_names):
+      if name not in projected:
+        names["#dynamodump_key" + str(i)] = name
+        projection_expression += ", #dynamodump_key" + str(i)
+    options["projection_expression"] = projection_expression
+  if names:
+    options["expression_attribute_names"] = names
+  if values:
+    options["expression_attribute_values"] = values
+  return options
+
+def add_expression(options, option, expression, attribute_names, attribute_values):
+  # copy of options with expression ANDed onto the filter or key condition option
+  options = dict(options)
+  if option in options:
+    expression = "(" + options[option] + ") AND " + expression
+  options[option] = expression
+  options["expression_attribute_names"] = dict(options.get("expression_attribute_names", {}), **attribute_names)
+  options["expression_attribute_values"] = dict(options.get("expression_attribute_values", {}), **attribute_values)
+  return options
+
+def query_table(conn, table_name, key_condition_expression, exclusive_start_key=None,
+                return_consumed_capacity=None, filter_expression=None, projection_expression=None,
+                expression_attribute_names=None, expression_attribute_values=None):
+  # boto's query() only takes the legacy KeyConditions, which DynamoDB refuses alongside
+  # filter and projection expressions, so the request is built with a KeyConditionExpression
+  params = {"TableName": table_name, "KeyConditionExpression": key_condition_expression}
+  if exclusive_start_key is not None:
+    params["ExclusiveStartKey"] = exclusive_start_key
+  if return_consumed_capacity is not None:
+    params["ReturnConsumedCapacity"] = return_consumed_capacity
+  if filter_expression is not None:
+    params["FilterExpression"] = filter_expression
+  if projection_expression is not None:
+    params["ProjectionExpression"] = projection_expression
+  if expression_attribute_names is not None:
+    params["ExpressionAttributeNames"] = expression_attribute_names
+  if expression_attribute_values is not None:
+    params["ExpressionAttributeValues"] = expression_attribute_values
+  return conn.make_request(action="Query", body=json.dumps(params))
+
+def backup_segment(conn, table_name, table_path, uploader, checkpoint,
+                   segment=None, total_segments=None, rate_limiter=None,
+                   dump_format="json", scan_options={}, table_metrics=None, key_names=()):
+  segment_state = checkpoint.segment_state(segment)
+  if segment_state["Done"]:
+    logging.info("Segment " + str(segment or 0) + " of " + table_name + " already completed, skipping")
+    return
+
+  # subset backups by partition key run one query per key as a segment of their own
+  query = "key_condition_expression" in scan_options
+  if query:
+    logging.info("Querying partition key " + str(segment) + "/" + str(total_segments) + " of " + table_name)
+  elif segment is not None:
+    logging.info("Scanning segment " + str(segment) + "/" + str(total_segments) + " of " + table_name)
+
+  # continue after the last file known to be written
+  i = segment_state["File"] + 1
+  item_count = segment_state["Items"]
+  last_evaluated_key = segment_state["LastEvaluatedKey"]
+  if i > 1:
+    logging.info("Resuming " + table_name + " segment " + str(segment or 0) + " after file " + str(i - 1) + ", " + str(item_count) + " items already dumped")
+  remove_stale_files(table_path, uploader, segment, i - 1)
+
+  chunk_writer = None
+  if dump_format != "json":
+    chunk_writer = ChunkWriter(table_path, uploader, dump_format, segment, i, key_names)
+
+  for scanned_table in scan_pages(conn, table_name, segment, total_segments, rate_limiter, table_metrics,
+                                  exclusive_start_key=last_evaluated_key, **scan_options):
+    item_count += len(scanned_table["Items"])
+    last_evaluated_key = scanned_table.get("LastEvaluatedKey")
+
+    started = time.time()
+    if chunk_writer:
+      content = "".join([encode_json(item) + "\n" for item in scanned_table["Items"]])
+    else:
+      content = encode_json(scanned_table)
+    serialized = time.time()
+    if chunk_writer:
+      chunk_writer.write(content, scanned_table["Items"])
+      # chunks only roll between pages, so every chunk ends on a key to resume from
+      if last_evaluated_key is None or chunk_writer.size >= MAX_CHUNK_SIZE:
+        chunk_writer.close(functools.partial(checkpoint.file_written, segment, chunk_writer.chunk,
+                                             last_evaluated_key))
+    else:
+      path = table_path + "/" + DATA_DIR + "/" + data_file_name(i, segment)
+      entry = manifest_entry(len(scanned_table["Items"]), len(content), hashlib.sha256(content),
+                             merge_key_range(None, scanned_table["Items"], key_names))
+      write_dump_file(uploader, path, content,
+                      functools.partial(checkpoint.file_written, segment, i, last_evaluated_key, entry))
+      i += 1
+    if table_metrics:
+      table_metrics.add(segment, bytes=len(content), serialize_seconds=serialized - started,
+                        write_seconds=time.time() - serialized)
+
+  files = i - 1
+  if chunk_writer:
+    files = chunk_writer.chunk
+
+  # mark segment as complete, a missing marker means the segment dump is partial
+  if segment is not None:
+    marker = {"Segment": segment, "TotalSegments": total_segments,
+              "Files": files, "Items": item_count}
+    path = table_path + "/" + SEGMENT_DIR + "/" + str(segment).zfill(4) + ".done"
+    write_dump_file(uploader, path, json.dumps(marker, indent=JSON_INDENT))
+    logging.info("Segment " + str(segment) + "/" + str(total_segments) + " of " + table_name + " completed, " + str(item_count) + " items")
+
 def do_backup(conn, table_name, read_capacity,
-              s3conn, s3bucket, s3location, dump_path):
+              s3conn, s3bucket, s3location, dump_path, segments=1,
+              capacity_ratio=None, dump_format="json",
+              s3_upload_threads=S3_UPLOAD_THREADS, s3_upload_memory=S3_UPLOAD_MEMORY,
+              resume=False, incremental_attribute=None, timestamp_format="epoch",
+              filter_expression=None, projection_expression=None,
+              expression_attribute_names=None, expression_attribute_values=None, query_keys=None):
   # if dump path is passed in, override the default dump path
-  if dump_path:
-    DUMP_PATH = dump_path
+  if not dump_path:
+    dump_path = DUMP_PATH
+
+  # subset backups keep the items matching a filter, or under some partition keys, and
+  # the attributes of a projection. the options, placeholders included, are recorded in
+  # the manifest and to resume with the same ones
+  subset = {}
+  if filter_expression:
+    subset["Filter"] = filter_expression
+  if projection_expression:
+    subset["Projection"] = projection_expression
+  if subset and expression_attribute_names:
+    subset["ExpressionAttributeNames"] = expression_attribute_names
+  if subset and expression_attribute_values:
+    subset["ExpressionAttributeValues"] = expression_attribute_values
+  if query_keys:
+    subset["QueryKeys"] = query_keys
+  total_segments = segments
+  if query_keys:
+    total_segments = len(query_keys)
 
   logging.info("Starting backup for " + table_name + "..")
 
   # if s3 bucket is passed, create <bucket>/<table name>
+  uploader = None
+  bucket_id = None
   if s3bucket:
     bucket_id = create_s3_bucket(s3conn, s3location, s3bucket)
-  else:
-    # trash data, re-create subdir
-    if os.path.exists(DUMP_PATH + "/" + table_name):
-      shutil.rmtree(DUMP_PATH + "/" + table_name)
-    mkdir_p(DUMP_PATH + "/" + table_name)
+    uploader = S3Uploader(s3conn, bucket_id, s3_upload_threads, s3_upload_memory * 1024 * 1024)
+
+  # incremental backups dump only the items changed since the previous dump of the
+  # table into <table>/deltas/<sequence>, which restores replay over the base dump
+  table_path = dump_path + "/" + table_name
+  backup_path = table_path
+  if incremental_attribute:
+    base = read_json_file(table_path + "/" + SNAPSHOT_FILE, bucket_id)
+    if base is None:
+      logging.error("Cannot find a complete base dump of " + table_name + ", run a full backup before an incremental one")
+      sys.exit(1)
+    deltas = list_deltas(table_path, bucket_id)
+    previous = base
+    if len(deltas) > 0:
+      previous = deltas[-1][1]
+    sequence = str(len(deltas) + 1).zfill(4)
+    backup_path = table_path + "/" + DELTA_DIR + "/" + sequence
+    since = format_timestamp(previous["StartTime"] - INCREMENTAL_OVERLAP, timestamp_format)
+
+  # pick up from the checkpoint of a previous run if resuming
+  checkpoint_path = backup_path + "/" + CHECKPOINT_FILE
+  state = None
+  if resume:
+    state = read_json_file(checkpoint_path, bucket_id)
+    if state is None:
+      logging.info("No checkpoint found for " + table_name + ", starting the backup over")
+    elif state.get("Subset", {}) != subset:
+      logging.error("Cannot resume backup of " + table_name + ", it was started with other --filter, --projection, --expressionNames, --expressionValues or --queryKeys options")
+      sys.exit(1)
+    elif state["TotalSegments"] != total_segments or state["Format"] != dump_format:
+      logging.error("Cannot resume backup of " + table_name + ", it was started with --segments " + str(state["TotalSegments"]) + " --format " + state["Format"])
+      sys.exit(1)
+    else:
+      logging.info("Resuming backup for " + table_name + " from checkpoint")
+
+  if state is None:
+    state = {"TotalSegments": total_segments, "Format": dump_format, "Segments": {}, "StartTime": time.time()}
+    if incremental_attribute:
+      state["Since"] = since
+    if subset:
+      state["Subset"] = subset
+    # trash data, a new base dump also invalidates the deltas taken against the old one
+    remove_dump_path(backup_path, bucket_id)
+    if not s3bucket:
+      mkdir_p(backup_path)
+  checkpoint = BackupCheckpoint(checkpoint_path, state, uploader)
 
   table_desc = conn.describe_table(table_name)
-
-  # if s3bucket is passed, create schema file in bucket
-  if s3bucket:
-    path = DUMP_PATH + "/" + table_name + "/" + SCHEMA_FILE
-    content = json.dumps(table_desc, indent=JSON_INDENT)
-    s3_file_write(s3conn, bucket_id, content, path)
+  expected_items = None
+  if not incremental_attribute and not filter_expression and not query_keys:
+    expected_items = table_desc["Table"].get("ItemCount")
+  table_metrics = track_table(table_name, "backup", expected_items)
+  table_key_names = key_names(table_desc["Table"]["KeySchema"])
+
+  scan_options = scan_expressions(filter_expression, projection_expression, expression_attribute_names,
+                                  expression_attribute_values, table_key_names)
+  if incremental_attribute:
+    logging.info("Dumping items of " + table_name + " with " + incremental_attribute + " since " + json.dumps(state["Since"]) + " as delta " + sequence)
+    scan_options = add_expression(scan_options, "filter_expression", "#dynamodump_updated >= :dynamodump_since",
+                                  {"#dynamodump_updated": incremental_attribute},
+                                  {":dynamodump_since": state["Since"]})
   else:
     # get table schema
     logging.info("Dumping table schema for " + table_name)
-    f = open(DUMP_PATH + "/" + table_name + "/" + SCHEMA_FILE, "w+")
-    f.write(json.dumps(table_desc, indent=JSON_INDENT))
-    f.close()
+    path = table_path + "/" + SCHEMA_FILE
+    write_dump_file(uploader, path, json.dumps(table_desc, indent=JSON_INDENT))
+
+  # segment options, the query of each partition key adds its key condition
+  segment_options = lambda segment: scan_options
+  if query_keys:
+    hash_key_type = [definition["AttributeType"] for definition in table_desc["Table"]["AttributeDefinitions"]
+                     if definition["AttributeName"] == table_key_names[0]][0]
+    segment_options = lambda segment: add_expression(scan_options, "key_condition_expression",
+                                                     "#dynamodump_hash = :dynamodump_hash",
+                                                     {"#dynamodump_hash": table_key_names[0]},
+                                                     {":dynamodump_hash": {hash_key_type: query_keys[segment]}})
 
   original_read_capacity = table_desc["Table"]["ProvisionedThroughput"]["ReadCapacityUnits"]
   original_write_capacity = table_desc["Table"]["ProvisionedThroughput"]["WriteCapacityUnits"]
@@ -233,72 +1994,96 @@ def do_backup(conn, table_name, read_capacity,
   if read_capacity != None and read_capacity != original_read_capacity:
     update_provisioned_throughput(conn, table_name, read_capacity, original_write_capacity)
 
+  # consume only a fraction of the read capacity if requested, instead of changing it
+  rate_limiter = get_rate_limiter(table_name, "read", read_capacity or original_read_capacity, capacity_ratio)
+
   # get table data
   logging.info("Dumping table items for " + table_name)
 
-  i = 1
-  last_evaluated_key = None
-
-  while True:
-    scanned_table = conn.scan(table_name, exclusive_start_key=last_evaluated_key)
+  failed_segments = []
+  if total_segments > 1 or query_keys:
+    # parallel scan with one worker per segment, or queries on up to --segments workers
+    pending_segments = Queue.Queue()
+    for segment in range(total_segments):
+      pending_segments.put(segment)
 
-    if s3bucket:
-      path = DUMP_PATH + "/" + table_name + "/" + DATA_DIR + "/" + str(i).zfill(4) + ".json"
-      content = json.dumps(scanned_table, indent=JSON_INDENT)
-      s3_file_write(s3conn, bucket_id, content, path)
+    def scan_segments():
+      while True:
+        try:
+          segment = pending_segments.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          backup_segment(conn, table_name, backup_path, uploader, checkpoint, segment, total_segments,
+                         rate_limiter, dump_format, segment_options(segment), table_metrics, table_key_names)
+        except Exception, e:
+          logging.exception(e)
+          failed_segments.append(segment)
+
+    threads = []
+    for i in range(max(1, min(segments, total_segments))):
+      t = threading.Thread(target=scan_segments)
+      threads.append(t)
+      t.start()
+
+    for thread in threads:
+      thread.join()
+  else:
+    try:
+      backup_segment(conn, table_name, backup_path, uploader, checkpoint,
+                     rate_limiter=rate_limiter, dump_format=dump_format, scan_options=scan_options,
+                     table_metrics=table_metrics, key_names=table_key_names)
+    except Exception, e:
+      logging.exception(e)
+      failed_segments.append(0)
+
+  # keep the files written so far and their progress, so --resume continues after them
+  if len(failed_segments) > 0:
+    if uploader:
+      uploader.close()
+    checkpoint.save()
+    table_metrics.finish("failed")
+    if total_segments > 1 or query_keys:
+      logging.error("Backup for " + table_name + " failed, segment(s) " + ", ".join(map(str, sorted(failed_segments))) + " did not complete")
     else:
-      mkdir_p(DUMP_PATH + "/" + table_name + "/" + DATA_DIR)
-      f = open(DUMP_PATH + "/" + table_name + "/" + DATA_DIR + "/" + str(i).zfill(4) + ".json", "w+")
-      f.write(json.dumps(scanned_table, indent=JSON_INDENT))
-      f.close()
+      logging.error("Backup for " + table_name + " failed, its scan did not complete")
+    sys.exit(1)
+
+  # wait for background uploads to drain
+  if uploader:
+    failed_uploads = uploader.close()
+    checkpoint.save()
+    if len(failed_uploads) > 0:
+      table_metrics.finish("failed")
+      logging.error("Backup for " + table_name + " failed, " + str(len(failed_uploads)) + " file(s) could not be uploaded: " + ", ".join(failed_uploads))
+      sys.exit(1)
 
-    i += 1
-    try:
-      last_evaluated_key = scanned_table["LastEvaluatedKey"]
-    except KeyError, e:
-      break
+  checkpoint.save()
+
+  # item counts, sizes, hashes and key ranges of the data files, checked by --mode verify
+  write_json_file(backup_path + "/" + MANIFEST_FILE,
+                  dump_manifest(table_name, state, table_desc["Table"]["KeySchema"]), uploader)
+
+  # the snapshot file marks the dump complete and is the starting point of the next delta
+  snapshot = {"StartTime": state["StartTime"], "Format": dump_format}
+  if incremental_attribute:
+    snapshot.update({"Base": base["StartTime"], "Sequence": int(sequence),
+                     "Attribute": incremental_attribute, "Since": state["Since"]})
+  write_json_file(backup_path + "/" + SNAPSHOT_FILE, snapshot, uploader)
 
   # revert back to original table read capacity if specified
   if read_capacity != None and read_capacity != original_read_capacity:
     update_provisioned_throughput(conn, table_name, original_read_capacity, original_write_capacity, False)
 
-  logging.info("Backup for " + table_name + " table completed. Time taken: " + str(datetime.datetime.now().replace(microsecond=0) - start_time))
-
-def do_restore(conn, sleep_interval, source_table,
-               destination_table, write_capacity,
-               s3conn, s3bucket, dump_path):
-  if dump_path:
-    DUMP_PATH = dump_path
-
-  logging.info("Starting restore for " + source_table + " to " + destination_table + "..")
+  table_metrics.finish()
+  logging.info("Backup for " + table_name + " table completed. Time taken: " + str(datetime.timedelta(seconds=int(table_metrics.elapsed()))) + ", " + table_metrics.progress())
 
-  if s3bucket:
-    try:
-      bucket = s3conn.get_bucket(s3bucket)
-    except boto.exception.S3ResponseError:
-      logging.info("Bucket: %s does not exist" % s3bucket)
-
-    print dump_path
-    for f in bucket.list(prefix=dump_path):
-      print f.name
-
-    sys.exit()
-
-  # create table using schema
-  # restore source_table from dump directory if it exists else try current working directory
-  if os.path.exists("%s/%s" % (DUMP_PATH, source_table)):
-    dump_data_path = DUMP_PATH
-  else:
-    logging.info("Cannot find \"./%s/%s\", Now trying current working directory.." % (DUMP_PATH, source_table))
-    if os.path.exists("%s/%s" % (CURRENT_WORKING_DIR, source_table)):
-      dump_data_path = CURRENT_WORKING_DIR
-    else:
-      logging.info("Cannot find \"%s/%s\" directory containing dump files!" % (CURRENT_WORKING_DIR, source_table))
-      sys.exit(1)
-  table_data = json.load(open(dump_data_path + "/" + source_table + "/" + SCHEMA_FILE))
-  table = table_data["Table"]
+def restore_table(conn, sleep_interval, source_table, table, destination_tables, write_capacity, load,
+                  write_threads=RESTORE_WRITE_THREADS, capacity_ratio=None, resume=False,
+                  shared_rate_limit=False, defer_indexes=False, checkpointed=True, operation="restore"):
+  # creates the destination tables from the schema of source_table, then load(targets)
+  # writes the items to them, after which deferred indexes are added and capacities reverted
   table_attribute_definitions = table["AttributeDefinitions"]
-  table_table_name = destination_table
   table_key_schema = table["KeySchema"]
   original_read_capacity = table["ProvisionedThroughput"]["ReadCapacityUnits"]
   original_write_capacity = table["ProvisionedThroughput"]["WriteCapacityUnits"]
@@ -313,10 +2098,11 @@ def do_restore(conn, sleep_interval, source_table,
       write_capacity = original_write_capacity
 
   # override GSI write capacities if specified, else use RESTORE_WRITE_CAPACITY if original write capacity is lower
-  original_gsi_write_capacities = []
+  original_gsi_capacities = {}
   if table_global_secondary_indexes is not None:
     for gsi in table_global_secondary_indexes:
-      original_gsi_write_capacities.append(gsi["ProvisionedThroughput"]["WriteCapacityUnits"])
+      original_gsi_capacities[gsi["IndexName"]] = (gsi["ProvisionedThroughput"]["ReadCapacityUnits"],
+                                                   gsi["ProvisionedThroughput"]["WriteCapacityUnits"])
 
       if gsi["ProvisionedThroughput"]["WriteCapacityUnits"] < RESTORE_WRITE_CAPACITY:
         gsi["ProvisionedThroughput"]["WriteCapacityUnits"] = RESTORE_WRITE_CAPACITY
@@ -324,99 +2110,727 @@ def do_restore(conn, sleep_interval, source_table,
   # temp provisioned throughput for restore
   table_provisioned_throughput = {"ReadCapacityUnits": int(original_read_capacity), "WriteCapacityUnits": int(write_capacity)}
 
-  logging.info("Creating " + destination_table + " table with temp write capacity of " + str(write_capacity))
-
-  while True:
-    try:
-      conn.create_table(table_attribute_definitions, table_table_name, table_key_schema, table_provisioned_throughput, table_local_secondary_indexes, table_global_secondary_indexes)
-      break
-    except boto.exception.JSONResponseError, e:
-      if e.body["__type"] == "com.amazonaws.dynamodb.v20120810#LimitExceededException":
-        logging.info("Limit exceeded, retrying creation of " + destination_table + "..")
-        time.sleep(sleep_interval)
-      elif e.body["__type"] == "com.amazon.coral.availability#ThrottlingException":
-        logging.info("Control plane limit exceeded, retrying creation of " + destination_table + "..")
-        time.sleep(sleep_interval)
-      else:
-        logging.exception(e)
+  # deferred GSIs are added once the items are loaded, so writes do not fan out into
+  # every index during the load and each index is backfilled in one pass instead
+  key_schemas = [table_key_schema] + [lsi["KeySchema"] for lsi in table_local_secondary_indexes or []]
+  create_attribute_definitions = table_attribute_definitions
+  create_global_secondary_indexes = table_global_secondary_indexes
+  if defer_indexes and table_global_secondary_indexes is not None:
+    create_attribute_definitions = key_attribute_definitions(table_attribute_definitions, key_schemas)
+    create_global_secondary_indexes = None
+
+  # a resumed restore continues into the tables created by the previous run
+  checkpoints = []
+  for destination_table in destination_tables:
+    checkpoint_path = CHECKPOINT_DIR + "/" + destination_table + ".restore.json"
+    state = None
+    if resume:
+      state = read_json_file(checkpoint_path)
+      if state is None:
+        logging.info("No checkpoint found for " + destination_table + ", starting a full restore")
+        delete_table(conn, sleep_interval, destination_table)
+      elif state["Source"] != source_table:
+        logging.error("Cannot resume restore of " + destination_table + ", its checkpoint is for " + state["Source"])
         sys.exit(1)
+      else:
+        logging.info("Resuming restore for " + destination_table + " from checkpoint, " + str(len(state["CompletedFiles"])) + " data file(s) already restored")
+
+    if state is None:
+      state = {"Source": source_table, "CompletedFiles": [], "Offsets": {}}
+
+      logging.info("Creating " + destination_table + " table with temp write capacity of " + str(write_capacity))
+
+      while True:
+        try:
+          conn.create_table(create_attribute_definitions, destination_table, table_key_schema, table_provisioned_throughput, table_local_secondary_indexes, create_global_secondary_indexes)
+          table_catalog(conn).invalidate()
+          break
+        except boto.exception.JSONResponseError, e:
+          if e.body["__type"] == "com.amazonaws.dynamodb.v20120810#LimitExceededException":
+            logging.info("Limit exceeded, retrying creation of " + destination_table + "..")
+            time.sleep(sleep_interval)
+          elif e.body["__type"] == "com.amazon.coral.availability#ThrottlingException":
+            logging.info("Control plane limit exceeded, retrying creation of " + destination_table + "..")
+            time.sleep(sleep_interval)
+          else:
+            logging.exception(e)
+            sys.exit(1)
+    # copies have nothing stable to resume from, their progress is not recorded
+    checkpoints.append(RestoreCheckpoint(checkpoint_path, state) if checkpointed else None)
 
   # wait for table creation completion
-  wait_for_active_table(conn, destination_table, "created")
+  for destination_table in destination_tables:
+    wait_for_active_table(conn, destination_table, "created")
+
+  targets = []
+  for destination_table, checkpoint in zip(destination_tables, checkpoints):
+    targets.append(RestoreTarget(conn, destination_table, write_threads,
+                                 get_rate_limiter(destination_table, "write", write_capacity, capacity_ratio, shared_rate_limit),
+                                 checkpoint, track_table(destination_table, operation, table.get("ItemCount"))))
+  try:
+    load(targets)
+  except Exception, e:
+    # e.g. a data file that could not be read or downloaded, the batches written before it are kept
+    for target in targets:
+      if target.checkpoint:
+        target.checkpoint.save()
+      target.table_metrics.finish("failed")
+    raise
+
+  failed_targets = [target for target in targets if len(target.failures) > 0]
+  if len(failed_targets) > 0:
+    for target in targets:
+      if target.checkpoint:
+        target.checkpoint.save()
+    for target in failed_targets:
+      target.table_metrics.finish("failed")
+      logging.error(operation.capitalize() + " of " + source_table + " to " + target.table_name + " failed, " + str(len(target.failures)) + " batch write(s) raised errors" + (", rerun with --resume to continue" if target.checkpoint else ""))
+    sys.exit(1)
+
+  # indexes are created one at a time per table, the tables' backfills run concurrently.
+  # checkpoints are kept until then, so a resumed restore picks up missing indexes.
+  if create_global_secondary_indexes is None and table_global_secondary_indexes is not None:
+    creating = destination_tables
+    while len(creating) > 0:
+      creating = [destination_table for destination_table in creating
+                  if create_next_index(conn, destination_table, table_attribute_definitions,
+                                       key_schemas, table_global_secondary_indexes)]
+      for destination_table in creating:
+        wait_for_active_table(conn, destination_table, "indexed")
+
+  for target in targets:
+    destination_table = target.table_name
+    if target.checkpoint:
+      target.checkpoint.remove()
+
+    # revert the table and GSI write capacities changed for the restore in one call
+    updates = capacity_update(conn.describe_table(destination_table)["Table"], original_read_capacity,
+                              original_write_capacity, original_gsi_capacities)
+    if len(updates) > 0:
+      logging.info("Reverting " + destination_table + " table and global secondary index capacities..")
+      update_table(conn, destination_table, **updates)
+
+    target.table_metrics.finish()
+    logging.info(operation.capitalize() + " for " + source_table + " to " + destination_table + " table completed. Time taken: " + str(datetime.timedelta(seconds=int(target.table_metrics.elapsed()))) + ", " + target.table_metrics.progress())
 
-  # read data files
-  logging.info("Restoring data for " + destination_table + " table..")
-  data_file_list = os.listdir(dump_data_path + "/" + source_table + "/" + DATA_DIR + "/")
-  data_file_list.sort()
+def do_restore(conn, sleep_interval, source_table,
+               destination_table, write_capacity,
+               s3conn, s3bucket, dump_path,
+               write_threads=RESTORE_WRITE_THREADS, capacity_ratio=None,
+               s3_prefetch=S3_PREFETCH, resume=False, processes=1, defer_indexes=False):
+  if not dump_path:
+    dump_path = DUMP_PATH
 
-  for data_file in data_file_list:
-    logging.info("Processing " + data_file + " of " + destination_table)
-    items = []
-    item_data = json.load(open(dump_data_path + "/" + source_table + "/" + DATA_DIR + "/" + data_file))
-    items.extend(item_data["Items"])
-
-    # batch write data
-    put_requests = []
-    while len(items) > 0:
-      put_requests.append({"PutRequest": {"Item": items.pop(0)}})
-
-      # flush every MAX_BATCH_WRITE
-      if len(put_requests) == MAX_BATCH_WRITE:
-        logging.debug("Writing next " + str(MAX_BATCH_WRITE) + " items to " + destination_table + "..")
-        batch_write(conn, sleep_interval, destination_table, put_requests)
-        del put_requests[:]
-
-    # flush remainder
-    if len(put_requests) > 0:
-      batch_write(conn, sleep_interval, destination_table, put_requests)
-
-  # revert to original table write capacity if it has been modified
-  if write_capacity != original_write_capacity:
-    update_provisioned_throughput(conn, destination_table, original_read_capacity, original_write_capacity, False)
-
-  # loop through each GSI to check if it has changed and update if necessary
-  if table_global_secondary_indexes is not None:
-    gsi_data = []
-    for gsi in table_global_secondary_indexes:
-      original_gsi_write_capacity = original_gsi_write_capacities.pop(0)
-      if original_gsi_write_capacity != gsi["ProvisionedThroughput"]["WriteCapacityUnits"]:
-        gsi_data.append({"Update": { "IndexName" : gsi["IndexName"], "ProvisionedThroughput": { "ReadCapacityUnits": int(gsi["ProvisionedThroughput"]["ReadCapacityUnits"]), "WriteCapacityUnits": int(original_gsi_write_capacity),},},})
+  # destination_table is a table name, or a list of them to restore the dump into at once
+  destination_tables = destination_table
+  if isinstance(destination_table, basestring):
+    destination_tables = [destination_table]
+
+  logging.info("Starting restore for " + source_table + " to " + ", ".join(destination_tables) + "..")
+
+  # create table using schema
+  bucket_id, table_path = locate_dump(source_table, s3conn, s3bucket, dump_path)
+  table_data = read_json_file(table_path + "/" + SCHEMA_FILE, bucket_id)
+
+  # read data files, the base dump first then each delta in order. every dump is
+  # fully written before the next starts so newer versions of items always win
+  dumps = list_dumps(table_path, bucket_id)
+
+  def load(targets):
+    # every data file is decoded once and written to all destination tables
+    table_metrics = MetricsGroup([target.table_metrics for target in targets])
+    for name_prefix, path in dumps:
+      if name_prefix:
+        logging.info("Replaying " + name_prefix.rstrip("/") + " of " + source_table + " to " + ", ".join(destination_tables) + "..")
+      else:
+        logging.info("Restoring data for " + ", ".join(destination_tables) + " table(s)..")
+      # only files restored to every destination are skipped without reading them
+      exclude = set.intersection(*[set(target.checkpoint.state["CompletedFiles"]) for target in targets])
+      if processes > 1:
+        restore_processes(conn, targets, s3conn, bucket_id, path, name_prefix, exclude,
+                          processes, write_threads, s3_prefetch)
+      else:
+        if s3bucket:
+          # stream objects straight from S3 into the writers, nothing is staged on disk
+          item_pages = iter_s3_data_files(s3conn, bucket_id, path + "/" + DATA_DIR + "/", s3_prefetch,
+                                          exclude, name_prefix, table_metrics)
+        else:
+          item_pages = iter_data_files(path + "/" + DATA_DIR, exclude, name_prefix, table_metrics)
+        restore_targets(targets, item_pages)
+      # a failed dump is not followed by the deltas replayed over it
+      if len([target for target in targets if len(target.failures) > 0]) > 0:
+        return
+
+  restore_table(conn, sleep_interval, source_table, table_data["Table"], destination_tables, write_capacity, load,
+                write_threads, capacity_ratio, resume, processes > 1, defer_indexes)
+
+def table_identity(table_desc):
+  # ARNs only tell tables of different regions or accounts apart, and every DynamoDB
+  # Local has the same account, so the table id and creation time are compared as well
+  return (table_desc.get("TableArn"), table_desc.get("TableId"), table_desc.get("CreationDateTime"))
+
+def same_table(conn, table_desc, other_conn, other_table_name):
+  # whether other_table_name, reached through other_conn, is the table of table_desc.
+  # the same endpoint can be reached under several names, e.g. localhost and 127.0.0.1,
+  # so the tables themselves are compared rather than the connections
+  if other_table_name != table_desc["TableName"]:
+    return False
+  if other_conn is conn:
+    return True
+  try:
+    other_desc = other_conn.describe_table(other_table_name)["Table"]
+  except boto.exception.JSONResponseError, e:
+    if e.body["__type"] == "com.amazonaws.dynamodb.v20120810#ResourceNotFoundException":
+      return False
+    raise
+  identity = table_identity(table_desc)
+  # tables telling nothing about themselves are assumed to be the same
+  return identity == (None, None, None) or identity == table_identity(other_desc)
+
+def iter_table_pages(conn, table_name, segments, failed_segments, prefetch=COPY_PREFETCH,
+                     rate_limiter=None, table_metrics=None, bytes_metrics=None):
+  # parallel scan of table_name, one thread per segment puts its pages on a bounded
+  # queue so the scan runs at most prefetch pages ahead of the writers. segments that
+  # raised are appended to failed_segments once their pages are consumed. the JSON size
+  # of every page is added to bytes_metrics
+  if segments < 1:
+    raise ValueError("segments must be at least 1, no page would be scanned")
+  pages = Queue.Queue(maxsize=prefetch)
+  stopped = threading.Event()
+
+  def scanner(segment):
+    try:
+      if segments > 1:
+        scanned_pages = scan_pages(conn, table_name, segment, segments, rate_limiter, table_metrics)
+      else:
+        scanned_pages = scan_pages(conn, table_name, rate_limiter=rate_limiter, table_metrics=table_metrics)
+      for page, scanned_table in enumerate(scanned_pages, 1):
+        if bytes_metrics:
+          bytes_metrics.add(bytes=len(encode_json(scanned_table["Items"])))
+        if not put_until_stopped(pages, (data_file_name(page, segment if segments > 1 else None, "scan"),
+                                         scanned_table["Items"]), stopped):
+          return
+    except Exception, e:
+      logging.exception(e)
+      failed_segments.append(segment)
+    finally:
+      put_until_stopped(pages, None, stopped)
+
+  for segment in range(segments):
+    t = threading.Thread(target=scanner, args=(segment,))
+    t.daemon = True
+    t.start()
+
+  try:
+    remaining = segments
+    while remaining > 0:
+      page = pages.get()
+      if page is None:
+        remaining -= 1
+        continue
+      yield page
+  finally:
+    stopped.set()
+
+def do_copy(conn, sleep_interval, source_table, destination_conn, destination_table,
+            write_capacity=None, segments=1, write_threads=RESTORE_WRITE_THREADS,
+            capacity_ratio=None, defer_indexes=False):
+  # streams a parallel scan of source_table into batch writes to destination_table,
+  # which destination_conn may reach in another region or account. nothing is staged
+  # in between, so a copy cannot be resumed and the destination table is replaced
+  logging.info("Starting copy of " + source_table + " to " + destination_table + "..")
+
+  # refused before the destination is deleted, which would delete the source
+  table_desc = conn.describe_table(source_table)
+  if same_table(conn, table_desc["Table"], destination_conn, destination_table):
+    logging.error("Cannot copy " + source_table + " onto itself")
+    sys.exit(1)
+  read_rate_limiter = get_rate_limiter(source_table, "read", table_desc["Table"]["ProvisionedThroughput"]["ReadCapacityUnits"],
+                                       capacity_ratio)
+  scan_metrics = track_table(source_table, "copy_scan", table_desc["Table"].get("ItemCount"))
+  delete_table(destination_conn, sleep_interval, destination_table)
+
+  failed_segments = []
+
+  def load(targets):
+    logging.info("Copying data of " + source_table + " to " + destination_table + " table..")
+    # the bytes of a copy are those of its items as JSON, as an uncompressed dump would hold them
+    bytes_metrics = MetricsGroup([scan_metrics] + [target.table_metrics for target in targets])
+    restore_targets(targets, iter_table_pages(conn, source_table, segments, failed_segments,
+                                              rate_limiter=read_rate_limiter, table_metrics=scan_metrics,
+                                              bytes_metrics=bytes_metrics))
+    if len(failed_segments) > 0:
+      scan_metrics.finish("failed")
+      for target in targets:
+        target.table_metrics.finish("failed")
+      logging.error("Copy of " + source_table + " to " + destination_table + " failed, scanning segment(s) " + ", ".join([str(segment) for segment in sorted(failed_segments)]) + " raised errors")
+      sys.exit(1)
+    scan_metrics.finish()
+
+  restore_table(destination_conn, sleep_interval, source_table, table_desc["Table"], [destination_table],
+                write_capacity, load, write_threads, capacity_ratio, defer_indexes=defer_indexes,
+                checkpointed=False, operation="copy")
 
-    logging.info("Updating " + destination_table + " global secondary indexes write capacities as necessary..")
+def data_file_digest(path, s3conn=None, bucket_id=None):
+  # (bytes, sha256 hex digest) of a data file as stored
+  if bucket_id:
+    f = StringIO(Key(thread_bucket(s3conn, bucket_id), path).get_contents_as_string())
+  else:
+    f = open(path, "rb")
+  digest = hashlib.sha256()
+  size = 0
+  try:
     while True:
-      try:
-        conn.update_table(destination_table, global_secondary_index_updates=gsi_data)
+      block = f.read(READ_BLOCK_SIZE)
+      if not block:
         break
-      except boto.exception.JSONResponseError, e:
-        if e.body["__type"] == "com.amazonaws.dynamodb.v20120810#LimitExceededException":
-          logging.info("Limit exceeded, retrying updating throughput of GlobalSecondaryIndexes in " + destination_table + "..")
-          time.sleep(sleep_interval)
-        elif e.body["__type"] == "com.amazon.coral.availability#ThrottlingException":
-          logging.info("Control plane limit exceeded, retrying updating throughput of GlobalSecondaryIndexes in " + destination_table + "..")
-          time.sleep(sleep_interval)
+      digest.update(block)
+      size += len(block)
+  finally:
+    f.close()
+  return size, digest.hexdigest()
+
+def verify_dump_files(path, manifest, s3conn=None, bucket_id=None, threads=S3_PREFETCH):
+  # checks the data files of a dump against its manifest, returns the problems found
+  data_path = path + "/" + DATA_DIR
+  if bucket_id:
+    stored = [key.name.rsplit("/", 1)[-1] for key in bucket_id.list(prefix=data_path + "/")]
+  elif os.path.exists(data_path):
+    stored = os.listdir(data_path)
+  else:
+    stored = []
+  stored = sorted([data_file for data_file in stored if data_file_format(data_file)])
+
+  problems = [data_file + " is missing" for data_file in sorted(manifest["Files"]) if data_file not in stored]
+  problems.extend([data_file + " is not in the manifest" for data_file in stored if data_file not in manifest["Files"]])
 
-  logging.info("Restore for " + source_table + " to " + destination_table + " table completed. Time taken: " + str(datetime.datetime.now().replace(microsecond=0) - start_time))
+  data_files = Queue.Queue()
+  for data_file in stored:
+    if data_file in manifest["Files"]:
+      data_files.put(data_file)
+
+  def worker():
+    while True:
+      try:
+        data_file = data_files.get_nowait()
+      except Queue.Empty:
+        return
+      entry = manifest["Files"][data_file]
+      try:
+        size, digest = data_file_digest(data_path + "/" + data_file, s3conn, bucket_id)
+      except Exception, e:
+        problems.append(data_file + " cannot be read: " + str(e))
+        continue
+      if size != entry["Bytes"]:
+        problems.append(data_file + " has " + str(size) + " bytes, the manifest records " + str(entry["Bytes"]))
+      elif digest != entry["Sha256"]:
+        problems.append(data_file + " does not match its sha256 in the manifest")
+
+  workers = []
+  for i in range(threads):
+    t = threading.Thread(target=worker)
+    workers.append(t)
+    t.start()
+
+  for t in workers:
+    t.join()
+
+  return problems
+
+def scan_pages(conn, table_name, segment=None, total_segments=None, rate_limiter=None, table_metrics=None,
+               exclusive_start_key=None, **scan_options):
+  # pages of a scan of table_name (or of one segment of it) from exclusive_start_key on,
+  # throttled requests are retried. scan_options with a key_condition_expression query
+  # the table instead, segment then only labels the metrics
+  query = "key_condition_expression" in scan_options
+  last_evaluated_key = exclusive_start_key
+  attempt = 1
+  while True:
+    if rate_limiter:
+      rate_limiter.acquire()
+    started = time.time()
+    try:
+      if query:
+        scanned_table = query_table(conn, table_name, exclusive_start_key=last_evaluated_key,
+                                    return_consumed_capacity="TOTAL", **scan_options)
+      else:
+        scanned_table = conn.scan(table_name, exclusive_start_key=last_evaluated_key,
+                                  segment=segment, total_segments=total_segments,
+                                  return_consumed_capacity="TOTAL", **scan_options)
+    except boto.exception.JSONResponseError, e:
+      if throughput_exceeded(e):
+        logging.debug("Throughput exceeded scanning " + table_name + ", backing off.. [" + str(attempt) + "]")
+        if table_metrics:
+          table_metrics.add(segment, requests=1, throttles=1)
+        time.sleep(backoff_delay(attempt))
+        attempt += 1
+        continue
+      raise
+    attempt = 1
+    if rate_limiter:
+      rate_limiter.consume(consumed_capacity_units(scanned_table))
+    if table_metrics:
+      table_metrics.add(segment, requests=1, items=scanned_table["Count"],
+                        capacity_units=consumed_capacity_units(scanned_table),
+                        scan_seconds=time.time() - started)
+    yield scanned_table
+    last_evaluated_key = scanned_table.get("LastEvaluatedKey")
+    if last_evaluated_key is None:
+      return
+
+def count_segment(conn, table_name, segment=None, total_segments=None, rate_limiter=None, table_metrics=None):
+  # Select=COUNT scan, only the counts of each page come back
+  count = 0
+  for scanned_table in scan_pages(conn, table_name, segment, total_segments, rate_limiter, table_metrics,
+                                  select="COUNT"):
+    count += scanned_table["Count"]
+  return count
+
+def count_table_items(conn, table_name, segments=1, rate_limiter=None, table_metrics=None):
+  # parallel count scan, one thread per segment. returns None if a segment failed
+  if segments <= 1:
+    return count_segment(conn, table_name, rate_limiter=rate_limiter, table_metrics=table_metrics)
+
+  counts = {}
+
+  def count(segment):
+    try:
+      counts[segment] = count_segment(conn, table_name, segment, segments, rate_limiter, table_metrics)
+    except Exception, e:
+      logging.exception(e)
+
+  threads = []
+  for segment in range(segments):
+    t = threading.Thread(target=count, args=(segment,))
+    threads.append(t)
+    t.start()
+
+  for thread in threads:
+    thread.join()
+
+  if len(counts) < segments:
+    return None
+  return sum(counts.values())
+
+def sample_dump_items(path, manifest, samples, s3conn=None, bucket_id=None):
+  # picks items uniformly over the dump, only the data files they fall in are read
+  data_files = sorted(manifest["Files"])
+  offsets = []
+  total = 0
+  for data_file in data_files:
+    offsets.append(total)
+    total += manifest["Files"][data_file]["Items"]
+
+  picks = {}
+  for n in random.sample(xrange(total), min(samples, total)):
+    index = bisect.bisect_right(offsets, n) - 1
+    picks.setdefault(data_files[index], set()).add(n - offsets[index])
+
+  items = []
+  for data_file, indexes in sorted(picks.items()):
+    data_file_path = path + "/" + DATA_DIR + "/" + data_file
+    if bucket_id:
+      f = StringIO(Key(thread_bucket(s3conn, bucket_id), data_file_path).get_contents_as_string())
+    else:
+      f = open(data_file_path, "rb")
+    found = 0
+    for i, item in enumerate(iter_file_items(f, data_file_format(data_file))):
+      if i in indexes:
+        items.append(item)
+        found += 1
+        if found == len(indexes):
+          break
+  return items
+
+def normalize_value(value):
+  # sets come back in any order
+  for set_type in ("SS", "NS", "BS"):
+    if set_type in value:
+      return {set_type: sorted(value[set_type])}
+  if "M" in value:
+    return {"M": dict((name, normalize_value(member)) for name, member in value["M"].items())}
+  if "L" in value:
+    return {"L": [normalize_value(member) for member in value["L"]]}
+  return value
+
+def normalize_item(item):
+  return dict((name, normalize_value(value)) for name, value in item.items())
+
+def batch_get_items(conn, table_name, keys, rate_limiter=None, table_metrics=None):
+  # consistent reads of keys, MAX_BATCH_GET at a time, unprocessed keys are retried with backoff
+  items = []
+  pending = list(keys)
+  attempt = 1
+  while len(pending) > 0:
+    batch = pending[:MAX_BATCH_GET]
+    pending = pending[MAX_BATCH_GET:]
+    if rate_limiter:
+      rate_limiter.acquire()
+    try:
+      response = conn.batch_get_item({table_name: {"Keys": batch, "ConsistentRead": True}},
+                                     return_consumed_capacity="TOTAL")
+    except boto.exception.JSONResponseError, e:
+      if throughput_exceeded(e):
+        logging.debug("Throughput exceeded reading " + table_name + ", backing off.. [" + str(attempt) + "]")
+        if table_metrics:
+          table_metrics.add(requests=1, throttles=1)
+        pending = batch + pending
+        time.sleep(backoff_delay(attempt))
+        attempt += 1
+        continue
+      raise
+    if rate_limiter:
+      rate_limiter.consume(consumed_capacity_units(response))
+    items.extend(response["Responses"].get(table_name, []))
+    unprocessed = response.get("UnprocessedKeys", {}).get(table_name, {}).get("Keys", [])
+    if table_metrics:
+      table_metrics.add(requests=1, capacity_units=consumed_capacity_units(response),
+                        unprocessed_items=len(unprocessed))
+    if len(unprocessed) > 0:
+      pending = unprocessed + pending
+      time.sleep(backoff_delay(attempt))
+      attempt += 1
+    else:
+      attempt = 1
+  return items
+
+def do_verify(conn, source_table, destination_table, s3conn, s3bucket, dump_path,
+              segments=1, samples=VERIFY_SAMPLES, capacity_ratio=None, threads=S3_PREFETCH):
+  # checks the dump of source_table against its manifests, then if destination_table is
+  # given compares that table against the dump with a count scan and sampled reads
+  if not dump_path:
+    dump_path = DUMP_PATH
+
+  logging.info("Starting verify of " + source_table + (" against " + destination_table if destination_table else "") + "..")
+
+  bucket_id, table_path = locate_dump(source_table, s3conn, s3bucket, dump_path)
+  table_metrics = track_table(destination_table or source_table, "verify")
+
+  problems = []
+  manifests = []
+  for name_prefix, path in list_dumps(table_path, bucket_id):
+    name = source_table + " " + (name_prefix.rstrip("/") or "base dump")
+    manifest = read_json_file(path + "/" + MANIFEST_FILE, bucket_id)
+    if manifest is None:
+      problems.append(name + " has no manifest, it was taken before manifests were written")
+      continue
+    logging.info("Checking " + str(len(manifest["Files"])) + " data file(s) of " + name + "..")
+    problems.extend(name + ": " + file_problem for file_problem in verify_dump_files(path, manifest, s3conn, bucket_id, threads))
+    manifests.append((path, manifest))
+
+  if destination_table and len(problems) == 0:
+    try:
+      table_desc = conn.describe_table(destination_table)
+    except boto.exception.JSONResponseError, e:
+      if e.body["__type"] != "com.amazonaws.dynamodb.v20120810#ResourceNotFoundException":
+        raise
+      table_desc = None
+      problems.append(destination_table + " table does not exist")
+
+  if destination_table and len(problems) == 0:
+    rate_limiter = get_rate_limiter(destination_table, "read",
+                                    table_desc["Table"]["ProvisionedThroughput"]["ReadCapacityUnits"], capacity_ratio)
+    if len(manifests) == 1:
+      table_metrics.expected_items = manifests[0][1]["Items"]
+      logging.info("Counting items of " + destination_table + "..")
+      count = count_table_items(conn, destination_table, segments, rate_limiter, table_metrics)
+      if count is None:
+        problems.append("counting the items of " + destination_table + " failed")
+      elif count != manifests[0][1]["Items"]:
+        problems.append(destination_table + " has " + str(count) + " items, the dump has " + str(manifests[0][1]["Items"]))
+    else:
+      logging.info("Not comparing the item count of " + destination_table + ", deltas update items of the base dump")
+
+    # nothing is replayed over the items of the newest dump, so they are compared as is
+    path, manifest = manifests[-1]
+    names = key_names(manifest["KeySchema"])
+    expected_items = sample_dump_items(path, manifest, samples, s3conn, bucket_id)
+    logging.info("Reading back " + str(len(expected_items)) + " sampled item(s) from " + destination_table + "..")
+    keys = [dict((name, expected_item[name]) for name in names) for expected_item in expected_items]
+    found = {}
+    for item in batch_get_items(conn, destination_table, keys, rate_limiter, table_metrics):
+      found[json.dumps([item[key_name] for key_name in names], sort_keys=True)] = normalize_item(item)
+    for key, item in zip(keys, expected_items):
+      found_item = found.get(json.dumps([key[key_name] for key_name in names], sort_keys=True))
+      if found_item is None:
+        problems.append(destination_table + " is missing item " + json.dumps(key, sort_keys=True))
+      elif found_item != normalize_item(item):
+        problems.append(destination_table + " item " + json.dumps(key, sort_keys=True) + " differs from the dump")
+
+  if len(problems) > 0:
+    table_metrics.finish("failed")
+    for problem in problems:
+      logging.error(problem)
+    logging.error("Verify of " + source_table + " failed, " + str(len(problems)) + " problem(s) found")
+    sys.exit(1)
+
+  table_metrics.finish()
+  logging.info("Verify of " + source_table + (" against " + destination_table if destination_table else "") + " completed, " + str(sum(len(dump_manifest["Files"]) for dump_path, dump_manifest in manifests)) + " data file(s) match their manifest. Time taken: " + str(datetime.timedelta(seconds=int(table_metrics.elapsed()))))
+
+# library API for running dynamodump from other programs. each job runs do_backup,
+# do_restore or do_copy on a thread of its own, so several can run at once: start()
+# returns immediately and wait() blocks until the job is done, returning True if it
+# completed. failures are logged as on the command line and kept in error. the tables a
+# job tracks are kept by the job rather than in table_metrics_registry, see metrics(), e.g.
+#
+#   conn = connect("us-west-1")
+#   jobs = [Backup(conn, "users", dump_path="dump").start(),
+#           Copy(conn, "orders", destination_table="orders-copy").start()]
+#   completed = all([job.wait() for job in jobs])
+class Job(object):
+
+  def __init__(self):
+    self.thread = None
+    self.error = None
+    self.done = threading.Event()
+    self.table_metrics = []
+
+  def start(self):
+    self.thread = threading.Thread(target=self._run)
+    self.thread.start()
+    return self
+
+  def _run(self):
+    table_metrics_scope.registry = self.table_metrics
+    try:
+      self.run()
+    except SystemExit, e:
+      self.error = e
+    except Exception, e:
+      logging.exception(e)
+      self.error = e
+    finally:
+      self.done.set()
+
+  def run(self):
+    raise NotImplementedError
+
+  def wait(self, timeout=None):
+    # False if the job failed, or is still running after timeout seconds
+    self.done.wait(timeout)
+    return self.done.is_set() and self.error is None
+
+  def metrics(self):
+    # summary of the tables of this job, as written by --metricsFile
+    return metrics_summary(self.table_metrics)
+
+# options are the keyword arguments of do_backup
+class Backup(Job):
+
+  def __init__(self, conn, table_name, **options):
+    Job.__init__(self)
+    self.options = dict(conn=conn, table_name=table_name, read_capacity=None, s3conn=None,
+                        s3bucket=None, s3location=None, dump_path=None)
+    self.options.update(options)
+
+  def run(self):
+    do_backup(**self.options)
+
+# options are the keyword arguments of do_restore, the destination tables are replaced
+# unless resuming
+class Restore(Job):
+
+  def __init__(self, conn, source_table, destination_table=None, sleep_interval=AWS_SLEEP_INTERVAL, **options):
+    Job.__init__(self)
+    self.options = dict(conn=conn, sleep_interval=sleep_interval, source_table=source_table,
+                        destination_table=destination_table or source_table, write_capacity=None,
+                        s3conn=None, s3bucket=None, dump_path=None)
+    self.options.update(options)
+
+  def run(self):
+    if not self.options.get("resume"):
+      destination_tables = self.options["destination_table"]
+      if isinstance(destination_tables, basestring):
+        destination_tables = [destination_tables]
+      for destination_table in destination_tables:
+        delete_table(self.options["conn"], self.options["sleep_interval"], destination_table)
+    do_restore(**self.options)
+
+# options are the keyword arguments of do_copy, destination_conn defaults to conn
+class Copy(Job):
+
+  def __init__(self, conn, source_table, destination_table=None, destination_conn=None,
+               sleep_interval=AWS_SLEEP_INTERVAL, **options):
+    Job.__init__(self)
+    self.options = dict(conn=conn, sleep_interval=sleep_interval, source_table=source_table,
+                        destination_conn=destination_conn or conn,
+                        destination_table=destination_table or source_table)
+    self.options.update(options)
+
+  def run(self):
+    do_copy(**self.options)
 
 if __name__ == '__main__':
 # parse args
   parser = argparse.ArgumentParser(description="Simple DynamoDB backup/restore.")
   parser.add_argument("-m", "--mode",
-    help="'backup' or 'restore'")
+    help="'backup', 'restore', 'verify' or 'copy'. 'verify' checks a dump against its manifest and, with --destTable, compares that table against the dump. 'copy' streams the source table straight into the destination table, which --dest* options may place in another region or account")
   parser.add_argument("-r", "--region",
     help="AWS region to use, e.g. 'us-west-1'. Use '" + LOCAL_REGION + "' for local DynamoDB testing.")
   parser.add_argument("-s", "--srcTable",
-    help="Source DynamoDB table name to backup or restore from, use 'tablename*' for wildcard prefix selection")
+    help="Source DynamoDB table name to backup or restore from, use 'tablename*' for wildcard prefix selection, another glob such as '*-users' or 're:<regex>' to match whole table names")
   parser.add_argument("-d", "--destTable",
-    help="Destination DynamoDB table name to backup or restore to, use 'tablename*' for wildcard prefix selection (defaults to use '-' separator) [optional, defaults to source]")
+    help="Destination DynamoDB table name to backup or restore to, use 'tablename*' for wildcard prefix selection (defaults to use '-' separator). Separate several with commas to restore into all of them from one read of the dump [optional, defaults to source]")
   parser.add_argument("--prefixSeparator",
     help="Specify a different prefix separator, e.g. '.' [optional]")
   parser.add_argument("--noSeparator",
     action='store_true',
     help="Overrides the use of a prefix separator for backup wildcard searches, [optional]")
+  parser.add_argument("--tableWorkers",
+    type=int, default=TABLE_WORKERS,
+    help="Number of tables to backup, restore or delete at once in wildcard runs, largest tables first [defaults to " + str(TABLE_WORKERS) + ", optional]")
+  parser.add_argument("--segments",
+    type=int, default=1,
+    help="Number of parallel scan segments to backup each table with, data files are written as <segment>-<page>.json. Also the number of count scan segments in verify mode and of source scan segments in copy mode [optional, defaults to 1]")
+  parser.add_argument("--format",
+    default="json", choices=DUMP_FORMATS,
+    help="Format of backup data files, 'ndjson.gz' and 'ndjson.zst' stream one item per line into compressed chunk files, 'ndjson.zst' requires the zstandard package [optional, defaults to json]")
+  parser.add_argument("--jsonCodec",
+    default="auto", choices=JSON_CODECS,
+    help="JSON codec to encode and decode data files with, 'auto' uses ujson when installed [optional, defaults to auto]")
+  parser.add_argument("--incremental",
+    metavar="ATTRIBUTE",
+    help="Backup only the items whose ATTRIBUTE update timestamp is newer than the previous dump of the table, as a delta that restores replay over the base dump [optional]")
+  parser.add_argument("--timestampFormat",
+    default="epoch", choices=TIMESTAMP_FORMATS,
+    help="Format of the --incremental update timestamp attribute [optional, defaults to epoch]")
+  parser.add_argument("--filter",
+    metavar="EXPRESSION",
+    help="Backup only the items matching this FilterExpression, e.g. 'tenant = :tenant'. Filtered items still consume read capacity [optional]")
+  parser.add_argument("--projection",
+    metavar="EXPRESSION",
+    help="Backup only the attributes in this ProjectionExpression, e.g. 'title, price', key attributes are always kept [optional]")
+  parser.add_argument("--expressionNames",
+    metavar="JSON",
+    help="ExpressionAttributeNames of --filter and --projection as a JSON object, e.g. '{\"#size\": \"size\"}' [optional]")
+  parser.add_argument("--expressionValues",
+    metavar="JSON",
+    help="ExpressionAttributeValues of --filter as a JSON object, e.g. '{\":tenant\": {\"S\": \"acme\"}}' [optional]")
+  parser.add_argument("--queryKeys",
+    metavar="KEYS",
+    help="Backup only the items under these partition key values, comma separated or @file with one per line. Each key is read with its own Query instead of scanning the table, on up to --segments threads [optional]")
   parser.add_argument("--readCapacity",
     help="Change the temp read capacity of the DynamoDB table to backup from [optional]")
   parser.add_argument("--writeCapacity",
     help="Change the temp write capacity of the DynamoDB table to restore to [defaults to " + str(RESTORE_WRITE_CAPACITY) + ", optional]")
+  parser.add_argument("--writeThreads",
+    type=int, default=RESTORE_WRITE_THREADS,
+    help="Number of concurrent batch writers per table to restore with [defaults to " + str(RESTORE_WRITE_THREADS) + ", optional]")
+  parser.add_argument("--processes",
+    type=int, default=1,
+    help="Number of processes per table to restore with, data files are sharded over them and each runs --writeThreads writers [defaults to 1, optional]")
+  parser.add_argument("--deferIndexes",
+    action="store_true",
+    help="Create global secondary indexes after the items are restored instead of with the table, so restore writes do not fan out into every index [optional]")
+  parser.add_argument("--verifySamples",
+    type=int, default=VERIFY_SAMPLES,
+    help="Number of items sampled from the dump to read back from the table in verify mode [defaults to " + str(VERIFY_SAMPLES) + ", optional]")
+  parser.add_argument("--capacityRatio",
+    type=float,
+    help="Fraction of the table's provisioned read (backup) or write (restore) capacity to consume, e.g. 0.3, throttled client-side without changing the table [optional]")
+  parser.add_argument("--resume",
+    action="store_true",
+    help="Continue an interrupted backup or restore from its checkpoint instead of starting over [optional]")
   parser.add_argument("--host",
     help="Host of local DynamoDB [required only for local]")
   parser.add_argument("--port",
@@ -425,20 +2839,74 @@ if __name__ == '__main__':
     help="Access key of local DynamoDB [required only for local]")
   parser.add_argument("--secretKey",
     help="Secret key of local DynamoDB [required only for local]")
+  parser.add_argument("--destRegion",
+    help="AWS region of the destination table in copy mode, or '" + LOCAL_REGION + "' [optional, defaults to --region]")
+  parser.add_argument("--destHost",
+    help="Host of the destination local DynamoDB in copy mode [optional, defaults to --host]")
+  parser.add_argument("--destPort",
+    help="Port of the destination local DynamoDB in copy mode [optional, defaults to --port]")
+  parser.add_argument("--destAccessKey",
+    help="Access key of the destination in copy mode, e.g. of another account [optional, defaults to --accessKey]")
+  parser.add_argument("--destSecretKey",
+    help="Secret key of the destination in copy mode [optional, defaults to --secretKey]")
+  parser.add_argument("--maxConnections",
+    type=int, default=CONNECTION_POOL_SIZE,
+    help="Maximum number of DynamoDB and of s3 connections, one per worker thread until reached [defaults to " + str(CONNECTION_POOL_SIZE) + ", optional]")
+  parser.add_argument("--progressInterval",
+    type=int, default=PROGRESS_INTERVAL,
+    help="Seconds between progress reports of running tables [defaults to " + str(PROGRESS_INTERVAL) + ", optional]")
+  parser.add_argument("--metricsFile",
+    help="Write a JSON summary of throughput, consumed capacity, throttles and retries per table to this file [optional]")
+  parser.add_argument("--prometheusFile",
+    help="Keep a Prometheus textfile collector file with the same metrics up to date [optional]")
   parser.add_argument("--log",
     help="Logging level - DEBUG|INFO|WARNING|ERROR|CRITICAL [optional]")
   parser.add_argument("--s3bucket",
     help="Name of the s3 bucket to use for backup or restore")
   parser.add_argument("--s3location",
     help="Location where the s3 bucket resides")
+  parser.add_argument("--s3UploadThreads",
+    type=int, default=S3_UPLOAD_THREADS,
+    help="Number of concurrent uploads per table when backing up to s3 [defaults to " + str(S3_UPLOAD_THREADS) + ", optional]")
+  parser.add_argument("--s3UploadMemory",
+    type=int, default=S3_UPLOAD_MEMORY,
+    help="Megabytes of backup data allowed to wait for upload per table before scanning pauses [defaults to " + str(S3_UPLOAD_MEMORY) + ", optional]")
+  parser.add_argument("--s3Prefetch",
+    type=int, default=S3_PREFETCH,
+    help="Number of s3 objects to download ahead of the writers per table when restoring from s3, and of data files hashed at once in verify mode [defaults to " + str(S3_PREFETCH) + ", optional]")
+  parser.add_argument("--s3host",
+    help="Host of an s3 compatible endpoint, e.g. a local stand-in for testing [optional]")
+  parser.add_argument("--s3port",
+    type=int,
+    help="Port of an s3 compatible endpoint [optional]")
   parser.add_argument("--dumpPath",
     help="Path where backup will be stored or restore will be taken from")
   args = parser.parse_args()
 
-  # if s3bucket is specified, connect once and pass the connection around
-  # during execution
-  if args.s3bucket:
-    s3_conn = connect_to_s3()
+  if args.format == "ndjson.zst" and zstandard is None:
+    parser.error("the ndjson.zst format requires the zstandard package")
+  if args.jsonCodec == "ujson" and ujson is None:
+    parser.error("the ujson codec requires the ujson package")
+  if args.tableWorkers < 1:
+    parser.error("--tableWorkers must be at least 1")
+  if args.segments < 1:
+    parser.error("--segments must be at least 1")
+  if args.writeThreads < 1:
+    parser.error("--writeThreads must be at least 1")
+  if args.s3Prefetch < 1:
+    parser.error("--s3Prefetch must be at least 1")
+  json_codec_name, encode_json, decode_json = json_codec(args.jsonCodec)
+
+  try:
+    expression_names = json.loads(args.expressionNames) if args.expressionNames else None
+    expression_values = json.loads(args.expressionValues) if args.expressionValues else None
+  except ValueError, e:
+    parser.error("--expressionNames and --expressionValues must be JSON objects: " + str(e))
+  query_keys = None
+  if args.queryKeys and args.queryKeys.startswith("@"):
+    query_keys = [line.strip() for line in open(args.queryKeys[1:]) if line.strip()]
+  elif args.queryKeys:
+    query_keys = args.queryKeys.split(",")
 
   # set log level
   log_level = LOG_LEVEL
@@ -446,23 +2914,13 @@ if __name__ == '__main__':
     log_level = args.log.upper()
   logging.basicConfig(level=getattr(logging, log_level))
 
-  # instantiate connection
-  if args.region == LOCAL_REGION:
-    conn = DynamoDBConnection(
-      aws_access_key_id=args.accessKey,
-      aws_secret_access_key=args.secretKey,
-      host=args.host,
-      port=int(args.port),
-      is_secure=False
-    )
-    sleep_interval = LOCAL_SLEEP_INTERVAL
-  else:
-    conn = boto.dynamodb2.connect_to_region(
-      args.region,
-      aws_access_key_id=args.accessKey,
-      aws_secret_access_key=args.secretKey
-    )
-    sleep_interval = AWS_SLEEP_INTERVAL
+  # instantiate connection pools, every worker thread gets its own connections
+  conn = connect(args.region, args.host, args.port, args.accessKey, args.secretKey, args.maxConnections)
+  sleep_interval = region_sleep_interval(args.region)
+
+  s3_conn = None
+  if args.s3bucket:
+    s3_conn = ConnectionPool(functools.partial(connect_to_s3, args.s3host, args.s3port), args.maxConnections)
 
   # set prefix separator
   prefix_separator = DEFAULT_PREFIX_SEPARATOR
@@ -471,78 +2929,151 @@ if __name__ == '__main__':
   if args.noSeparator == True:
     prefix_separator = None
 
+  # log progress while running and write the metrics summary once done
+  stop_progress = threading.Event()
+  progress_thread = threading.Thread(target=report_progress,
+                                     args=(stop_progress, args.progressInterval, args.prometheusFile))
+  progress_thread.daemon = True
+  progress_thread.start()
+  atexit.register(report_metrics, args.metricsFile, args.prometheusFile)
+  # exit handlers run last in first out, the thread is stopped before interpreter teardown
+  atexit.register(progress_thread.join)
+  atexit.register(stop_progress.set)
+
   # do backup/restore
-  start_time = datetime.datetime.now().replace(microsecond=0)
   if args.mode == "backup":
-    if args.srcTable.find("*") != -1:
+    if is_table_pattern(args.srcTable):
       matching_backup_tables = get_table_name_matches(conn, args.srcTable, prefix_separator)
       logging.info("Found " + str(len(matching_backup_tables)) + " table(s) in DynamoDB host to backup: " + ", ".join(matching_backup_tables))
 
-      threads = []
-      for table_name in matching_backup_tables:
-        t = threading.Thread(target=do_backup,
-          args=(conn, table_name,
-                args.readCapacity, args.s3bucket,
-                args.s3location, args.dumpPath))
-        threads.append(t)
-        t.start()
-        time.sleep(THREAD_START_DELAY)
-
-      for thread in threads:
-        thread.join()
+      matching_backup_tables = order_tables_by_size(conn, matching_backup_tables)
+      failed_tables = run_table_jobs(
+        lambda table_name: do_backup(conn, table_name,
+                                     args.readCapacity, s3_conn, args.s3bucket,
+                                     args.s3location, args.dumpPath, args.segments,
+                                     args.capacityRatio, args.format,
+                                     args.s3UploadThreads, args.s3UploadMemory, args.resume,
+                                     args.incremental, args.timestampFormat,
+                                     args.filter, args.projection, expression_names, expression_values,
+                                     query_keys),
+        matching_backup_tables, args.tableWorkers, "backup")
+      if len(failed_tables) > 0:
+        sys.exit(1)
 
       logging.info("Backup of table(s) " + args.srcTable + " completed!")
     else:
       do_backup(conn, args.srcTable, args.readCapacity,
-        s3_conn, args.s3bucket, args.s3location, args.dumpPath)
+        s3_conn, args.s3bucket, args.s3location, args.dumpPath, args.segments,
+        args.capacityRatio, args.format,
+        args.s3UploadThreads, args.s3UploadMemory, args.resume,
+        args.incremental, args.timestampFormat,
+        args.filter, args.projection, expression_names, expression_values, query_keys)
   elif args.mode == "restore":
     if args.destTable != None:
-      dest_table = args.destTable
+      dest_tables = args.destTable.split(",")
     else:
-      dest_table = args.srcTable
-
-    if dest_table.find("*") != -1:
-      matching_destination_tables = get_table_name_matches(conn, dest_table, prefix_separator)
-      logging.info("Found " + str(len(matching_destination_tables)) + " table(s) in DynamoDB host to be deleted: " + ", ".join(matching_destination_tables))
-
-      threads = []
-      for table_name in matching_destination_tables:
-        t = threading.Thread(target=delete_table, args=(conn, sleep_interval, table_name,))
-        threads.append(t)
-        t.start()
-        time.sleep(THREAD_START_DELAY)
-
-      for thread in threads:
-        thread.join()
-
-      matching_restore_tables = get_restore_table_matches(args.srcTable, prefix_separator)
-      logging.info("Found " + str(len(matching_restore_tables)) + " table(s) in " + DUMP_PATH + " to restore: " + ", ".join(matching_restore_tables))
-
-      threads = []
-      for source_table in matching_restore_tables:
-        t = threading.Thread(target=do_restore,
-                             args=(conn, sleep_interval,
-                                   source_table, change_prefix(
-                                    source_table,
-                                    args.srcTable,
-                                    dest_table,
-                                    prefix_separator
-                                  ),
-                                   args.writeCapacity,
-                                   s3_conn,
-                                   args.s3bucket,
-                                   args.dumpPath))
-        threads.append(t)
-        t.start()
-        time.sleep(THREAD_START_DELAY)
-
-      for thread in threads:
-        thread.join()
+      dest_tables = [args.srcTable]
+    dest_table = ",".join(dest_tables)
+
+    if is_table_pattern(dest_table):
+      if len([table for table in dest_tables if not is_table_pattern(table)]) > 0:
+        parser.error("destination tables must all be wildcards or all be table names")
+
+      # resumed restores keep their tables, do_restore deletes any without a checkpoint
+      if not args.resume:
+        matching_destination_tables = []
+        for table in dest_tables:
+          matching_destination_tables.extend(get_table_name_matches(conn, table, prefix_separator))
+        logging.info("Found " + str(len(matching_destination_tables)) + " table(s) in DynamoDB host to be deleted: " + ", ".join(matching_destination_tables))
+
+        run_table_jobs(lambda table_name: delete_table(conn, sleep_interval, table_name),
+                       matching_destination_tables, args.tableWorkers, "deletion")
+
+      matching_restore_tables = get_restore_table_matches(args.srcTable, prefix_separator,
+                                                          s3_conn, args.s3bucket, args.dumpPath)
+      logging.info("Found " + str(len(matching_restore_tables)) + " table(s) in " + (args.dumpPath or DUMP_PATH) + " to restore: " + ", ".join(matching_restore_tables))
+
+      matching_restore_tables = order_dumps_by_size(matching_restore_tables, s3_conn, args.s3bucket, args.dumpPath)
+      failed_tables = run_table_jobs(
+        lambda source_table: do_restore(conn, sleep_interval,
+                                        source_table, [change_prefix(
+                                          source_table,
+                                          args.srcTable,
+                                          table,
+                                          prefix_separator
+                                        ) for table in dest_tables],
+                                        args.writeCapacity,
+                                        s3_conn,
+                                        args.s3bucket,
+                                        args.dumpPath,
+                                        args.writeThreads,
+                                        args.capacityRatio,
+                                        args.s3Prefetch,
+                                        args.resume,
+                                        args.processes,
+                                        args.deferIndexes),
+        matching_restore_tables, args.tableWorkers, "restore")
+      if len(failed_tables) > 0:
+        sys.exit(1)
 
       logging.info("Restore of table(s) " + args.srcTable + " to " +  dest_table + " completed!")
     else:
-      delete_table(conn, sleep_interval, dest_table)
+      if not args.resume:
+        for table in dest_tables:
+          delete_table(conn, sleep_interval, table)
       do_restore(conn, sleep_interval, args.srcTable,
-                 dest_table, args.writeCapacity, s3_conn,
-                 args.s3bucket, args.dumpPath)
+                 dest_tables, args.writeCapacity, s3_conn,
+                 args.s3bucket, args.dumpPath, args.writeThreads,
+                 args.capacityRatio, args.s3Prefetch, args.resume, args.processes, args.deferIndexes)
+  elif args.mode == "verify":
+    if is_table_pattern(args.srcTable):
+      matching_verify_tables = get_restore_table_matches(args.srcTable, prefix_separator,
+                                                         s3_conn, args.s3bucket, args.dumpPath)
+      logging.info("Found " + str(len(matching_verify_tables)) + " table(s) in " + (args.dumpPath or DUMP_PATH) + " to verify: " + ", ".join(matching_verify_tables))
+
+      failed_tables = run_table_jobs(
+        lambda source_table: do_verify(conn, source_table,
+                                       args.destTable and change_prefix(source_table, args.srcTable,
+                                                                        args.destTable, prefix_separator),
+                                       s3_conn, args.s3bucket, args.dumpPath, args.segments,
+                                       args.verifySamples, args.capacityRatio, args.s3Prefetch),
+        matching_verify_tables, args.tableWorkers, "verify")
+      if len(failed_tables) > 0:
+        sys.exit(1)
+
+      logging.info("Verify of table(s) " + args.srcTable + " completed!")
+    else:
+      do_verify(conn, args.srcTable, args.destTable, s3_conn, args.s3bucket, args.dumpPath,
+                args.segments, args.verifySamples, args.capacityRatio, args.s3Prefetch)
+  elif args.mode == "copy":
+    # the destination shares the source's connections unless it is reached differently
+    dest_region = args.destRegion or args.region
+    if args.destRegion or args.destHost or args.destPort or args.destAccessKey or args.destSecretKey:
+      dest_conn = connect(dest_region, args.destHost or args.host, args.destPort or args.port,
+                          args.destAccessKey or args.accessKey, args.destSecretKey or args.secretKey,
+                          args.maxConnections)
+    else:
+      dest_conn = conn
+    dest_sleep_interval = region_sleep_interval(dest_region)
+    dest_table = args.destTable or args.srcTable
+
+    if is_table_pattern(args.srcTable):
+      if not is_table_pattern(dest_table):
+        parser.error("the destination of a wildcard copy must be a wildcard")
+      matching_copy_tables = get_table_name_matches(conn, args.srcTable, prefix_separator)
+      logging.info("Found " + str(len(matching_copy_tables)) + " table(s) in DynamoDB host to copy: " + ", ".join(matching_copy_tables))
+
+      matching_copy_tables = order_tables_by_size(conn, matching_copy_tables)
+      failed_tables = run_table_jobs(
+        lambda source_table: do_copy(conn, dest_sleep_interval, source_table, dest_conn,
+                                     change_prefix(source_table, args.srcTable, dest_table, prefix_separator),
+                                     args.writeCapacity, args.segments, args.writeThreads,
+                                     args.capacityRatio, args.deferIndexes),
+        matching_copy_tables, args.tableWorkers, "copy")
+      if len(failed_tables) > 0:
+        sys.exit(1)
 
+      logging.info("Copy of table(s) " + args.srcTable + " to " + dest_table + " completed!")
+    else:
+      do_copy(conn, dest_sleep_interval, args.srcTable, dest_conn, dest_table,
+              args.writeCapacity, args.segments, args.writeThreads, args.capacityRatio, args.deferIndexes)